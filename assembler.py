@@ -1,46 +1,97 @@
 #!/usr/bin/env python
 
-import struct
+from array import array
 from common import *
+from image import write_image
 
-def calculate_label_offsets(ir):
-    offsets = {}
-    skews = []
-    saw_newline = True
+# The parser can't know how long a label operand will be, so the IR offsets
+# aren't addresses.  Labels are placed by walking the IR as a list of sizing
+# events instead: a label definition, a run of words of known length, or a
+# label reference.  A reference takes no extra word (the short literal form)
+# while its label is at or below 0x1f and one word otherwise.  Starting with
+# every reference short, each pass only lengthens references, so addresses
+# only grow and the passes stop as soon as nothing more needs lengthening.
+
+SHORT_LITERAL_MAX = 0x1f
+
+def sizing_events(ir):
+    """ (definitions, words, references) events from IR: labels before an
+        op or DAT on their line define it, labels after it are operands """
+    events = []
+    pending = 0
+    defining = True
     for item in ir:
-        if item[0] == "label":
-            if saw_newline:
-                offsets[item[1]] = item[2]
-            else:
-                skews.append(item[2])
-        if item[0] == "newline":
-            saw_newline = True
-        else:
-            saw_newline = False
-    for key in offsets.iterkeys():
-        skew = 0
-        val = offsets[key]
-        for pos in skews:
-            if pos < val:
-                skew += 1
-            else:
-                break
-        offsets[key] += skew
-    #for pair in offsets.iteritems():
-    #    print pair[0], "0x%x" % pair[1]
-    return offsets
-
-def compile_ir(ir):
-    """ compiles IR (list of typed tokens) to a yielded stream of bytes """
-    label_offsets = calculate_label_offsets(ir)
-    ir = iter(ir)
+        kind = item[0]
+        if kind == "newline":
+            defining = True
+        elif kind == "label":
+            if pending:
+                events.append(("words", pending))
+                pending = 0
+            events.append(("define" if defining else "refer", item[1]))
+        elif kind == "op":
+            defining = False
+            pending += 1
+        elif kind == "lit+reg" or kind == "address":
+            pending += 1
+        elif kind == "literal":
+            if item[1] > SHORT_LITERAL_MAX:
+                pending += 1
+        elif kind == "data":
+            defining = False
+            pending += len(item[1])
+    if pending:
+        events.append(("words", pending))
+    return events
+
+def calculate_label_offsets(ir, short_labels=True):
+    """ a symbol table of label name to address, in time linear in the IR
+        per relaxation pass; with short_labels, labels at or below 0x1f are
+        referenced with the one-word short literal form """
+    return resolve_labels(sizing_events(ir), short_labels)
+
+def resolve_labels(events, short_labels=True):
+    """ calculate_label_offsets, from sizing events """
+    names = set()
+    for kind, name in events:
+        if kind == "define":
+            if name in names:
+                raise Exception("Duplicate label: "+name)
+            names.add(name)
+    referenced = set(name for kind, name in events if kind == "refer")
+    for name in referenced - names:
+        raise Exception("Undefined label: "+name)
+    long_form = set() if short_labels else referenced
+    while True:
+        offsets = {}
+        addr = 0
+        for kind, value in events:
+            if kind == "words":
+                addr += value
+            elif kind == "define":
+                offsets[value] = addr
+            elif value in long_form:
+                addr += 1
+        grown = set(name for name in referenced - long_form if offsets[name] > SHORT_LITERAL_MAX)
+        if not grown:
+            return offsets
+        long_form |= grown
+
+def compile_ir(ir, tracer=None, short_labels=True, label_offsets=None, relocations=None):
+    """ compiles IR (list of typed tokens) to a yielded stream of bytes,
+        placing labels with label_offsets if it is given.  If relocations
+        is a list, (address, label) is appended to it for every word that
+        holds a label's address. """
+    if label_offsets is None:
+        label_offsets = calculate_label_offsets(ir, short_labels)
+    ir = iter(ir) if tracer is None else tracer.wrap("compile_ir", ir)
     b = 0x0000;
     pos = 0
+    addr = 0
     next_words = []
     try:
         while True:
             t = ir.next()
-            print t
             if t[0] == 'op':
                 assert pos == 0
                 num_args = 2
@@ -53,7 +104,6 @@ def compile_ir(ir):
                     num_args = 1
                 for i in xrange(num_args):
                     t = ir.next()
-                    print t
                     if t[0] == 'regname':
                         b |= (0x003f & REVERSE_REGLOOKUP[t[1]]) << pos
                     elif t[0] == 'regval':
@@ -83,28 +133,131 @@ def compile_ir(ir):
                             b |= 0x1f << pos
                             next_words.append(t[1])
                     elif t[0] == 'label':
-                        b |= 0x1f << pos
-                        next_words.append(label_offsets[t[1]])
+                        target = label_offsets[t[1]]
+                        if short_labels and target <= SHORT_LITERAL_MAX:
+                            b |= (0x003f & (target + 0x20)) << pos
+                        else:
+                            b |= 0x1f << pos
+                            if relocations is not None:
+                                relocations.append((addr + 1 + len(next_words), t[1]))
+                            next_words.append(target)
                     else:
                         raise Exception("Invalid token: "+str(t))
                     pos += 6
                 yield b
                 for w in next_words:
                     yield w
+                addr += 1 + len(next_words)
                 b = 0x0000
                 pos = 0
                 next_words = []
             elif t[0] == "data":
                 for d in t[1]:
                     yield d
+                addr += len(t[1])
             elif t[0] not in set(["newline", "comment", "label"]):
                 raise Exception("Unexpected token: "+str(t))
     except StopIteration:
         pass
 
-def assemble(source):
-    ir = list(parse(source))
-    return compile_ir(ir)
+def assemble(source, tracer=None, short_labels=True, optimize=False):
+    ir = list(parse(source, tracer))
+    if optimize:
+        # peephole imports this module
+        from peephole import optimize as optimize_ir
+        ir, report = optimize_ir(ir, short_labels)
+    return compile_ir(ir, tracer, short_labels)
+
+class AssemblySession(object):
+    """ assembles successive versions of a source, reusing the work done on
+        lines that haven't changed.  Each distinct line is parsed once; lines
+        that don't refer to labels are encoded once, and lines that do are
+        encoded again only when the addresses they refer to move. """
+    def __init__(self, short_labels=True):
+        self.short_labels = short_labels
+        # line -> (ir, sizing events, referenced labels, words or None)
+        self.lines = {}
+        # (line, referenced addresses) -> words
+        self.encoded = {}
+        self.image = array('H')
+        self.label_offsets = {}
+        # work done by the last assemble, for the curious
+        self.parsed = 0
+        self.compiled = 0
+
+    def _line(self, line):
+        record = self.lines.get(line)
+        if record is None:
+            self.parsed += 1
+            ir = list(parse([line]))
+            events = sizing_events(ir)
+            refs = tuple(name for kind, name in events if kind == "refer")
+            words = None
+            if not refs:
+                self.compiled += 1
+                words = array('H', compile_ir(ir, label_offsets={}))
+            record = (ir, events, refs, words)
+        return record
+
+    def assemble(self, source):
+        """ (image, changed): the image for the lines of source, and the
+            sorted, disjoint (start, end) word ranges where it differs from
+            the previous image.  Ranges past the end of a shorter image cover
+            words that are gone. """
+        self.parsed = self.compiled = 0
+        lines = {}
+        records = []
+        events = []
+        for line in source:
+            record = lines.get(line)
+            if record is None:
+                record = lines[line] = self._line(line)
+            records.append((line, record))
+            events.extend(record[1])
+        offsets = resolve_labels(events, self.short_labels)
+        encoded = {}
+        image = array('H')
+        for line, (ir, line_events, refs, words) in records:
+            if words is None:
+                key = (line, tuple(offsets[name] for name in refs))
+                words = encoded.get(key)
+                if words is None:
+                    words = self.encoded.get(key)
+                    if words is None:
+                        self.compiled += 1
+                        words = array('H', compile_ir(ir, short_labels=self.short_labels,
+                                                      label_offsets=offsets))
+                    encoded[key] = words
+            image.extend(words)
+        # only keep what the current source uses
+        self.lines = lines
+        self.encoded = encoded
+        changed = changed_ranges(self.image, image)
+        self.image = image
+        self.label_offsets = offsets
+        return image, changed
+
+def changed_ranges(old, new, chunk=64):
+    """ the (start, end) ranges where two word arrays differ, comparing a
+        chunk at a time and only looking at words inside differing chunks """
+    ranges = []
+    common = min(len(old), len(new))
+    for base in xrange(0, common, chunk):
+        top = min(base + chunk, common)
+        if old[base:top] == new[base:top]:
+            continue
+        for addr in xrange(base, top):
+            if old[addr] != new[addr]:
+                if ranges and ranges[-1][1] == addr:
+                    ranges[-1] = (ranges[-1][0], addr + 1)
+                else:
+                    ranges.append((addr, addr + 1))
+    if len(old) != len(new):
+        if ranges and ranges[-1][1] == common:
+            ranges[-1] = (ranges[-1][0], max(len(old), len(new)))
+        else:
+            ranges.append((common, max(len(old), len(new))))
+    return ranges
 
 from disassembler import decompilation_cases
 from parser import parse
@@ -120,6 +273,96 @@ def test_compilation():
         print "ACTUAL  ", ["0x%x" % x for x in actual]
         assert expected == actual
 
+def test_labels():
+    """ the long form must reproduce the original images exactly, and every
+        label must land where writing its address as a literal would put it """
+    import random
+    import re
+    from image import read_image
+    for name in ["fib", "fibtail", "genadd", "genmul", "notch", "dcpu16os"]:
+        with open(name+".dasm") as f:
+            lines = f.readlines()
+        with open(name+".dexe", 'rb') as f:
+            assert list(assemble(lines, short_labels=False)) == list(read_image(f))
+        short = list(assemble(lines))
+        print "--------"
+        print name, len(short), "words with short labels"
+    rng = random.Random(18)
+    for case in xrange(200):
+        lines = []
+        count = rng.randint(1, 12)
+        for i in xrange(rng.randint(5, 40)):
+            choice = rng.randint(0, 4)
+            if choice == 0:
+                lines.append(":l%d SET A, 0x1" % rng.randint(0, count - 1))
+            elif choice == 1:
+                lines.append("SET PC, l%d" % rng.randint(0, count - 1))
+            elif choice == 2:
+                lines.append("JSR l%d" % rng.randint(0, count - 1))
+            else:
+                lines.append(rng.choice(["SET A, 0x40", "ADD [0x1000], 0x1", "SET B, C"]))
+        defined = set()
+        for i, line in enumerate(lines):
+            match = re.match(":(l\\d+) ", line)
+            if match:
+                if match.group(1) in defined:
+                    lines[i] = line[len(match.group(0)):]
+                defined.add(match.group(1))
+        for i in xrange(count):
+            if "l%d" % i not in defined:
+                lines.append(":l%d SET A, 0x1" % i)
+        offsets = calculate_label_offsets(list(parse(lines)))
+        literal = [re.sub("(?<=[ ,])(l\\d+)$", lambda m: "0x%x" % offsets[m.group(1)], line) for line in lines]
+        assert list(assemble(lines)) == list(assemble(literal)), lines
+        long_form = calculate_label_offsets(list(parse(lines)), False)
+        assert all(long_form[name] >= addr for name, addr in offsets.iteritems())
+
+def test_session():
+    """ every edit must give the image a full assembly would, change only
+        the reported ranges, and redo only the edited lines """
+    import random
+    from itertools import count
+    from emu import DCPU
+    rng = random.Random(19)
+    fresh = count()
+    with open("dcpu16os.dasm") as f:
+        lines = f.readlines()
+    session = AssemblySession()
+    image, changed = session.assemble(lines)
+    assert list(image) == list(assemble(lines)) and changed == [(0, len(image))]
+    assert session.assemble(lines) == (image, []) and session.parsed == 0
+    dcpu = DCPU()
+    dcpu.load_program(image)
+    dcpu.run(1000)
+    # edits that leave every label defined
+    edits = [lambda ls, i: ls.__setitem__(i, "    SET A, 0x%x\n" % rng.randint(0, 0xffff)),
+             lambda ls, i: ls.insert(i, "    ADD B, 0x1\n"),
+             lambda ls, i: ls.insert(i, ":new_label_%d\n" % fresh.next()),
+             lambda ls, i: ls.pop(i)]
+    for n in xrange(50):
+        old = session.image
+        edit = rng.choice(edits)
+        i = rng.randint(1, len(lines) - 1)
+        if not lines[i].strip().startswith(":"):
+            edit(lines, i)
+        image, changed = session.assemble(lines)
+        assert list(image) == list(assemble(lines))
+        assert session.parsed <= 1
+        patched = array('H', old[:len(image)]) + array('H', [0] * max(0, len(image) - len(old)))
+        for start, end in changed:
+            patched[start:min(end, len(image))] = image[start:min(end, len(image))]
+            if end <= len(image):
+                dcpu.patch(start, image[start:end])
+                assert dcpu.memory[start:end] == image[start:end]
+                fresh_dcpu = DCPU()
+                fresh_dcpu.load_program(dcpu.memory)
+                assert dcpu._decode(start) == fresh_dcpu._decode(start)
+        assert patched == image
+        assert all(old[a] == image[a] for a in xrange(min(len(old), len(image)))
+                   if not any(start <= a < end for start, end in changed))
+    print "--------"
+    print "SESSION", len(lines), "lines,", len(image), "words"
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
@@ -128,8 +371,8 @@ if __name__ == "__main__":
             print ["0x%x" % x for x in program]
             if len(sys.argv) > 2:
                 with open(sys.argv[2], 'wb') as g:
-                    for word in program:
-                        packed = struct.pack('>H', word)
-                        g.write(packed)
+                    write_image(g, program)
             sys.exit()
     test_compilation()
+    test_labels()
+    test_session()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import zlib
+from multiprocessing import Pool, cpu_count
+from common import *
+from assembler import assemble
+from decode import decode_table
+from disassembler import decompile_lines
+from image import read_image, to_bytes
+from emu import DCPU, REGISTER_NAMES
+
+# Assembles, disassembles and runs many programs in one go, spread over a
+# process pool.  Jobs are numbered in the order they were collected and the
+# report is put back in that order, so it is the same however the workers
+# happened to finish.
+
+PROGRAM_EXTENSIONS = (".dasm", ".dexe")
+
+def collect_jobs(paths):
+    """ expands directories (their .dasm/.dexe files, sorted) and manifests
+        (one path per line, relative to the manifest, # for comments) into
+        a list of program paths """
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(PROGRAM_EXTENSIONS):
+                    jobs.append(os.path.join(path, name))
+        elif path.endswith(PROGRAM_EXTENSIONS):
+            jobs.append(path)
+        else:
+            base = os.path.dirname(path)
+            with open(path) as f:
+                for line in f:
+                    line = line.split("#")[0].strip()
+                    if line:
+                        jobs.extend(collect_jobs([os.path.join(base, line)]))
+    return jobs
+
+def image_crc(words):
+    """ crc32 of words as a big-endian image, the same on every host """
+    return zlib.crc32(to_bytes(words)) & 0xffffffff
+
+def run_job(job):
+    """ assemble (or load), disassemble and emulate one program; never
+        raises, failures are reported in the result """
+    index, path, max_cycles = job
+    result = {"index": index, "path": path, "failure": None}
+    stage = "load"
+    try:
+        if path.endswith(".dasm"):
+            stage = "assemble"
+            with open(path) as f:
+                prog = list(assemble(f.readlines()))
+        else:
+            with open(path, 'rb') as f:
+                prog = read_image(f)
+        result["words"] = len(prog)
+        result["image_crc"] = image_crc(prog)
+        stage = "disassemble"
+        result["lines"] = sum(1 for line in decompile_lines(prog))
+        stage = "emulate"
+        dcpu = DCPU()
+        dcpu.load_program(prog)
+        reason, cycles, detail = dcpu.run(max_cycles)
+        result["stop"] = reason
+        result["cycles"] = cycles
+        result["regs"] = list(dcpu.regs)
+        result["memory_crc"] = image_crc(dcpu.memory)
+        if reason == "fault":
+            result["failure"] = "emulate: "+detail
+    except Exception as e:
+        result["failure"] = "%s: %s" % (stage, e)
+    return result
+
+def run_batch(paths, max_cycles=1000000, processes=None):
+    """ runs every program found under paths, one worker per core unless
+        processes says otherwise; results come back in job order """
+    jobs = [(i, path, max_cycles) for i, path in enumerate(collect_jobs(paths))]
+    if processes == 1 or len(jobs) < 2:
+        results = map(run_job, jobs)
+    else:
+        workers = processes or cpu_count()
+        # built once here, so forked workers share it instead of each
+        # building their own
+        decode_table()
+        pool = Pool(workers)
+        try:
+            # a few chunks per worker keeps them busy without a round trip
+            # to the pool for every job
+            chunksize = len(jobs) // (4 * workers) + 1
+            results = list(pool.imap_unordered(run_job, jobs, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    return sorted(results, key=lambda result: result["index"])
+
+def format_result(result):
+    s = result["path"]
+    if "stop" in result:
+        s += "\t%d words\t%d lines\timage %08x\t%s after %d cycles\tmemory %08x\t%s" % (
+            result["words"], result["lines"], result["image_crc"], result["stop"],
+            result["cycles"], result["memory_crc"],
+            " ".join("%s=0x%x" % pair for pair in zip(REGISTER_NAMES, result["regs"])))
+    if result["failure"]:
+        s += "\tFAILED " + result["failure"]
+    return s
+
+def format_report(results):
+    """ one line per job plus a summary, in job order """
+    lines = [format_result(result) for result in results]
+    failures = sum(1 for result in results if result["failure"])
+    lines.append("%d jobs, %d failed" % (len(results), failures))
+    return "\n".join(lines)
+
+def test_batch():
+    """ the pool must give the same report as running each job alone """
+    import shutil
+    import tempfile
+    scratch = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(scratch, "broken.dasm"), "w") as f:
+            f.write("SET A, \n")
+        with open(os.path.join(scratch, "odd.dexe"), "wb") as f:
+            f.write("\x7c")
+        with open(os.path.join(scratch, "fault.dasm"), "w") as f:
+            f.write("SET A, 1\nDAT 0x0\n")
+        with open(os.path.join(scratch, "manifest"), "w") as f:
+            f.write("# a comment\n%s\n%s\n" % (os.path.abspath("fib.dasm"), os.path.abspath("notch.dexe")))
+        paths = ["."] + [scratch, os.path.join(scratch, "manifest")]
+        serial = run_batch(paths, 100000, processes=1)
+        pooled = run_batch(paths, 100000, processes=4)
+        report = format_report(pooled)
+        print "--------"
+        print report
+        assert report == format_report(serial)
+        assert [result["path"] for result in pooled] == collect_jobs(paths)
+        by_path = dict((os.path.basename(result["path"]), result) for result in pooled)
+        for name in ("broken.dasm", "odd.dexe", "fault.dasm"):
+            assert by_path[name]["failure"], name
+        assert by_path["fault.dasm"]["stop"] == "fault"
+        # one instruction and one data word
+        assert by_path["fault.dasm"]["lines"] == 2
+        for result in pooled:
+            if result["path"].endswith(".dexe") and "stop" in result:
+                dcpu = DCPU()
+                with open(result["path"], 'rb') as f:
+                    dcpu.load_program(read_image(f))
+                assert dcpu.run(100000) == (result["stop"], result["cycles"], None)
+                assert dcpu.regs == result["regs"]
+    finally:
+        shutil.rmtree(scratch)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # batch.py [dir|manifest|program ...]
+        print format_report(run_batch(sys.argv[1:]))
+        sys.exit()
+    test_batch()
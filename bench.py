@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import json
+import platform
+import resource
+import sys
+from multiprocessing import Pool
+from timeit import default_timer
+from common import *
+from parser import parse
+from assembler import assemble, compile_ir
+from decode import decode_table
+from disassembler import decompile_instructions
+from emu import DCPU
+from blocks import BlockDCPU
+from trans import translate
+
+# Throughput benchmarks for each stage of the toolchain.  Every benchmark
+# builds its input once, then times its stage over that input a few times
+# and keeps the best run.  Each runs in its own child process; a forked
+# child starts out with the parent's memory, so what is recorded is how far
+# the benchmark raised the child's peak above where it started.  Results
+# are saved as JSON; compare() flags any benchmark that got slower or bigger
+# than a baseline.
+
+SAMPLES = ["fib.dasm", "fibtail.dasm", "genmul.dasm", "notch.dasm", "dcpu16os.dasm"]
+
+# a long-running synthetic guest: counts A through all 16 bit values
+COUNT_LOOP = ":loop ADD A, 0x1\nIFN A, 0x0\nSET PC, loop\n:halt SET PC, halt"
+
+REPEATS = 3
+
+def sample_lines(scale):
+    """ the bundled sources, repeated until there are about scale lines """
+    lines = []
+    for name in SAMPLES:
+        with open(name) as f:
+            lines.extend(f.readlines())
+    return (lines * (scale / len(lines) + 1))[:scale]
+
+def sample_ir(scale):
+    """ the bundled sources' IR, repeated until there are about scale lines,
+        with each copy's labels renamed so they stay distinct """
+    irs = []
+    for name in SAMPLES:
+        with open(name) as f:
+            irs.append(list(parse(f.readlines())))
+    ir = []
+    lines = 0
+    copy = 0
+    while lines < scale:
+        for item in irs[copy % len(irs)]:
+            if item[0] == "label":
+                item = ("label", "%s_%d" % (item[1], copy), item[2])
+            elif item[0] == "newline":
+                lines += 1
+            ir.append(item)
+        copy += 1
+    return ir
+
+def sample_programs():
+    programs = []
+    for name in SAMPLES:
+        with open(name) as f:
+            programs.append(list(assemble(f.readlines())))
+    programs.append(list(assemble(COUNT_LOOP.split("\n"))))
+    return programs
+
+def instructions_to_halt(prog):
+    dcpu = DCPU()
+    dcpu.load_program(prog)
+    count = 0
+    while dcpu.step():
+        count += 1
+    return count
+
+def expression(depth, ops=("ADD", "SUB", "MUL", "DIV", "MOD", "SHL", "SHR", "XOR")):
+    """ a full binary expression tree and its node count """
+    if depth == 0:
+        return str(depth + 1), 1
+    left, left_nodes = expression(depth - 1, ops)
+    right, right_nodes = expression(depth - 1, ops[1:] + ops[:1])
+    return "(%s %s %s)" % (ops[0], left, right), left_nodes + right_nodes + 1
+
+# Each setup takes a scale and returns (work, unit, body): body() does one
+# timed pass over work units.
+
+def setup_emu_step(scale):
+    programs = sample_programs()
+    work = sum(instructions_to_halt(prog) for prog in programs)
+    def body():
+        for prog in programs:
+            dcpu = DCPU()
+            dcpu.load_program(prog)
+            while dcpu.step():
+                pass
+    return work, "instructions", body
+
+def setup_run(cls):
+    def setup(scale):
+        programs = sample_programs()
+        work = sum(instructions_to_halt(prog) for prog in programs)
+        def body():
+            for prog in programs:
+                dcpu = cls()
+                dcpu.load_program(prog)
+                dcpu.run(10000000)
+        return work, "instructions", body
+    return setup
+
+def setup_parse(scale):
+    lines = sample_lines(scale)
+    def body():
+        for item in parse(lines):
+            pass
+    return len(lines), "lines", body
+
+def setup_compile_ir(scale):
+    ir = sample_ir(scale)
+    work = len(list(compile_ir(ir)))
+    def body():
+        for word in compile_ir(ir):
+            pass
+    return work, "words", body
+
+def setup_decompile(scale):
+    words = list(compile_ir(sample_ir(scale / 4)))
+    def body():
+        decompile_instructions(words)
+    return len(words), "words", body
+
+def setup_translate(scale):
+    depth = 1
+    while 2 ** (depth + 2) <= scale / 8:
+        depth += 1
+    source, nodes = expression(depth)
+    sources = [expression(d)[0] for d in xrange(1, 6)] + [source]
+    work = sum(expression(d)[1] for d in xrange(1, 6)) + nodes
+    def body():
+        for source in sources:
+            for line in translate(source):
+                pass
+    return work, "nodes", body
+
+BENCHMARKS = [
+    ("emu_step", setup_emu_step),
+    ("emu_run", setup_run(DCPU)),
+    ("blocks_run", setup_run(BlockDCPU)),
+    ("parse", setup_parse),
+    ("compile_ir", setup_compile_ir),
+    ("decompile", setup_decompile),
+    ("translate", setup_translate),
+]
+
+def run_benchmark(name, scale=20000, repeats=REPEATS):
+    """ time one benchmark in this process: best of repeats passes """
+    # shared by several stages; built here so no pass times building it
+    decode_table()
+    # kilobytes on Linux
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    work, unit, body = dict(BENCHMARKS)[name](scale)
+    best = None
+    for i in xrange(repeats):
+        start = default_timer()
+        body()
+        seconds = default_timer() - start
+        if best is None or seconds < best:
+            best = seconds
+    return {"work": work, "unit": unit, "seconds": best,
+            "rate": work / best if best else 0.0,
+            "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory}
+
+def _run_isolated(args):
+    return run_benchmark(*args)
+
+def run_benchmarks(names=None, scale=20000, repeats=REPEATS):
+    """ runs each benchmark in a fresh child process and returns the
+        results keyed by name, with the interpreter they ran on """
+    results = {"python": platform.python_version(), "scale": scale, "benchmarks": {}}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        pool = Pool(1)
+        try:
+            results["benchmarks"][name] = pool.apply(_run_isolated, ((name, scale, repeats),))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+# ru_maxrss moves in coarse steps, so peak memory growth smaller than this
+# (in KB) is noise however it compares to the baseline
+MEMORY_FLOOR = 1024
+
+def compare(baseline, current, tolerance=0.1):
+    """ the benchmarks whose rate fell by more than tolerance relative to
+        baseline, or whose peak memory grew by more than that and by more
+        than MEMORY_FLOOR: (name, measure, old, new) """
+    regressions = []
+    for name in sorted(current["benchmarks"]):
+        if name not in baseline["benchmarks"]:
+            continue
+        old, new = baseline["benchmarks"][name], current["benchmarks"][name]
+        if new["rate"] < old["rate"] * (1 - tolerance):
+            regressions.append((name, "rate", old["rate"], new["rate"]))
+        if new["peak_memory"] - old["peak_memory"] > max(old["peak_memory"] * tolerance, MEMORY_FLOOR):
+            regressions.append((name, "peak_memory", old["peak_memory"], new["peak_memory"]))
+    return regressions
+
+def format_results(results):
+    lines = []
+    for name, setup in BENCHMARKS:
+        if name in results["benchmarks"]:
+            result = results["benchmarks"][name]
+            lines.append("%-12s %12.0f %s/s  (%d in %.3fs, peak %d KB)" % (
+                name, result["rate"], result["unit"], result["work"],
+                result["seconds"], result["peak_memory"]))
+    return "\n".join(lines)
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def test_bench():
+    """ every benchmark runs at a small scale, and compare spots a slowdown """
+    results = run_benchmarks(scale=400, repeats=1)
+    print "--------"
+    print format_results(results)
+    assert sorted(results["benchmarks"]) == sorted(name for name, setup in BENCHMARKS)
+    for result in results["benchmarks"].itervalues():
+        assert result["work"] > 0 and result["rate"] > 0 and result["peak_memory"] >= 0
+    assert compare(results, results) == []
+    slower = json.loads(json.dumps(results))
+    slower["benchmarks"]["parse"]["rate"] /= 2
+    assert compare(results, slower) == [("parse", "rate", results["benchmarks"]["parse"]["rate"],
+                                         slower["benchmarks"]["parse"]["rate"])]
+    # a step of ru_maxrss over an empty baseline is noise; megabytes are not
+    bigger = json.loads(json.dumps(results))
+    results["benchmarks"]["translate"]["peak_memory"] = 0
+    bigger["benchmarks"]["translate"]["peak_memory"] = 128
+    assert compare(results, bigger) == []
+    bigger["benchmarks"]["translate"]["peak_memory"] = 4096
+    assert compare(results, bigger) == [("translate", "peak_memory", 0, 4096)]
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        # bench.py compare [baseline.json] [current.json]
+        regressions = compare(load_results(sys.argv[2]), load_results(sys.argv[3]))
+        for regression in regressions:
+            print "REGRESSION %s %s: %r -> %r" % regression
+        sys.exit(1 if regressions else 0)
+    elif len(sys.argv) > 1:
+        # bench.py [results.json] [benchmark ...]
+        results = run_benchmarks(sys.argv[2:])
+        print format_results(results)
+        save_results(results, sys.argv[1])
+        sys.exit()
+    test_bench()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+from common import *
+from emu import *
+
+# A basic-block compiler for the emulator.  A block is a straight run of
+# instructions ending at a write to PC, a JSR or an IF*.  Each block is turned
+# into one Python function with its operands and opcodes inlined, and cached
+# by start address until memory it covers is written.
+
+# programs run to completion (or fault) under both engines and compared
+block_cases = [case[0] for case in emu_cases] + \
+              ["fib.dexe", "fibtail.dexe", "notch.dexe", "genmul.dexe", "dcpu16os.dexe"]
+
+MAX_BLOCK_INSTRUCTIONS = 256
+
+def _location(code, word, next_pc, lines, name):
+    """ emit the statements resolving an operand and return its location as
+        (kind, ref): ("reg", index), ("mem", expression), ("pc", None) or
+        ("lit", value) """
+    if code < 0x08:
+        return ("reg", code)
+    elif code < 0x10:
+        lines.append("%s = regs[%d]" % (name, code - 0x08))
+        return ("mem", name)
+    elif code < 0x18:
+        lines.append("%s = (regs[%d] + %d) & 0xffff" % (name, code - 0x10, word))
+        return ("mem", name)
+    elif code == 0x18:
+        lines.append("%s = regs[%d] = (regs[%d] + 1) & 0xffff" % (name, REG_SP, REG_SP))
+        return ("mem", name)
+    elif code == 0x19:
+        lines.append("%s = (regs[%d] + 1) & 0xffff" % (name, REG_SP))
+        return ("mem", name)
+    elif code == 0x1a:
+        lines.append("%s = regs[%d]" % (name, REG_SP))
+        lines.append("regs[%d] = (%s - 1) & 0xffff" % (REG_SP, name))
+        return ("mem", name)
+    elif code == 0x1b:
+        return ("reg", REG_SP)
+    elif code == 0x1c:
+        return ("pc", None)
+    elif code == 0x1d:
+        return ("reg", REG_O)
+    elif code == 0x1e:
+        return ("mem", str(word))
+    elif code == 0x1f:
+        return ("lit", word)
+    else:
+        return ("lit", code - 0x20)
+
+def _read(location, next_pc):
+    """ an expression for the value at a location; PC reads as the address of
+        the next instruction, exactly as the interpreter sees it """
+    kind, ref = location
+    if kind == "reg":
+        return "regs[%d]" % ref
+    elif kind == "mem":
+        return "mem[%s]" % ref
+    elif kind == "pc":
+        return str(next_pc)
+    else:
+        return str(ref)
+
+def _store(location, value, lines, bail):
+    """ emit a store to a location; writes to literals fail silently.
+        bail is the exit sequence used when a write lands on cached code. """
+    kind, ref = location
+    if kind == "reg":
+        lines.append("regs[%d] = %s" % (ref, value))
+    elif kind == "pc":
+        lines.append("regs[%d] = %s" % (REG_PC, value))
+    elif kind == "mem":
+        lines.append("mem[%s] = %s" % (ref, value))
+        lines.append("dirty[%s >> %d] = 1" % (ref, PAGE_BITS))
+        lines.append("if code_map[%s]:" % ref)
+        lines.append("    cpu._invalidate(%s)" % ref)
+        for line in bail:
+            lines.append("    "+line)
+
+def _basic(op, a, next_pc, lines, bail):
+    """ emit the body of a basic opcode; b's value is already in bv """
+    if op == 0x1:
+        _store(a, "bv", lines, bail)
+        return
+    lines.append("av = %s" % _read(a, next_pc))
+    if op == 0x2:
+        lines.append("x = av + bv")
+        lines.append("regs[%d] = x >> 16" % REG_O)
+        _store(a, "x & 0xffff", lines, bail)
+    elif op == 0x3:
+        lines.append("x = av - bv")
+        lines.append("regs[%d] = 0xffff if x < 0 else 0" % REG_O)
+        _store(a, "x & 0xffff", lines, bail)
+    elif op == 0x4:
+        lines.append("x = av * bv")
+        lines.append("regs[%d] = (x >> 16) & 0xffff" % REG_O)
+        _store(a, "x & 0xffff", lines, bail)
+    elif op == 0x5:
+        lines.append("if bv:")
+        lines.append("    regs[%d] = ((av << 16) / bv) & 0xffff" % REG_O)
+        lines.append("    x = av / bv")
+        lines.append("else:")
+        lines.append("    regs[%d] = x = 0" % REG_O)
+        _store(a, "x", lines, bail)
+    elif op == 0x6:
+        _store(a, "av % bv if bv else 0", lines, bail)
+    elif op == 0x7:
+        lines.append("x = av << bv")
+        lines.append("regs[%d] = (x >> 16) & 0xffff" % REG_O)
+        _store(a, "x & 0xffff", lines, bail)
+    elif op == 0x8:
+        lines.append("regs[%d] = ((av << 16) >> bv) & 0xffff" % REG_O)
+        _store(a, "av >> bv", lines, bail)
+    elif op == 0x9:
+        _store(a, "av & bv", lines, bail)
+    elif op == 0xa:
+        _store(a, "av | bv", lines, bail)
+    elif op == 0xb:
+        _store(a, "av ^ bv", lines, bail)
+    elif op == 0xc:
+        lines.append("cpu.skip_next = av != bv")
+    elif op == 0xd:
+        lines.append("cpu.skip_next = av == bv")
+    elif op == 0xe:
+        lines.append("cpu.skip_next = av <= bv")
+    elif op == 0xf:
+        lines.append("cpu.skip_next = (av & bv) == 0")
+
+def compile_block(cpu, start):
+    """ compile the basic block starting at start into a function
+        f(cpu, regs, mem, code_map, dirty) returning the number of instructions it
+        ran.  Returns (function, addresses, starts, cycles), where cycles[i] is
+        the cost of the first i instructions before any failed IF*, or None if
+        the first instruction can't be compiled (an unknown opcode, left to
+        the interpreter). """
+    body = []
+    addresses = []
+    starts = []
+    cycles = [0]
+    pc = start
+    count = 0
+    jumped = ended = False
+    while not ended and count < MAX_BLOCK_INSTRUCTIONS:
+        op, a, a_word, b, b_word, length, cost = cpu._decode(pc)
+        if op == 0 and a != REVERSE_NONOPLOOKUP["JSR"]:
+            break
+        next_pc = (pc + length) & 0xffff
+        count += 1
+        # leave mid-block, with the machine exactly as the interpreter would,
+        # when a store lands on cached code (possibly this very block)
+        bail = ["regs[%d] = %d" % (REG_PC, next_pc),
+                "cpu.last_pc = %d" % pc,
+                "return %d" % count]
+        body.append("# 0x%04x" % pc)
+        if op == 0:
+            b_loc = _location(b, b_word, next_pc, body, "b_addr")
+            body.append("target = %s" % _read(b_loc, next_pc))
+            body.append("cpu._push(%d)" % next_pc)
+            body.append("regs[%d] = target" % REG_PC)
+            jumped = ended = True
+        else:
+            a_loc = _location(a, a_word, next_pc, body, "a_addr")
+            b_loc = _location(b, b_word, next_pc, body, "b_addr")
+            body.append("bv = %s" % _read(b_loc, next_pc))
+            _basic(op, a_loc, next_pc, body, bail)
+            if op >= 0xc:
+                ended = True
+            elif a_loc[0] == "pc":
+                jumped = ended = True
+        addresses.extend((pc + i) & 0xffff for i in xrange(length))
+        starts.append(pc)
+        cycles.append(cycles[-1] + cost)
+        last_pc = pc
+        pc = next_pc
+    if not count:
+        return None
+    if not jumped:
+        body.append("regs[%d] = %d" % (REG_PC, pc))
+    body.append("cpu.last_pc = %d" % last_pc)
+    body.append("return %d" % count)
+    source = "def block(cpu, regs, mem, code_map, dirty):\n" + \
+             "".join("    "+line+"\n" for line in body)
+    namespace = {}
+    exec compile(source, "<block 0x%04x>" % start, "exec") in namespace
+    return (namespace["block"], addresses, starts, cycles)
+
+class BlockDCPU(DCPU):
+    """ a DCPU that can also run whole compiled basic blocks at a time """
+
+    def flush_decoded(self):
+        DCPU.flush_decoded(self)
+        # start address => (function, addresses, starts, cycles)
+        self.blocks = {}
+        # word address => start addresses of the blocks covering it
+        self.block_owners = {}
+
+    def _invalidate(self, addr):
+        DCPU._invalidate(self, addr)
+        for start in self.block_owners.pop(addr, ()):
+            block = self.blocks.pop(start, None)
+            if block is not None:
+                for covered in block[1]:
+                    owners = self.block_owners.get(covered)
+                    if owners is not None:
+                        owners.discard(start)
+
+    def _block(self, start):
+        block = self.blocks.get(start)
+        if block is None:
+            block = compile_block(self, start)
+            if block is not None:
+                self.blocks[start] = block
+                for covered in block[1]:
+                    self.block_owners.setdefault(covered, set()).add(start)
+        return block
+
+    def step_block(self):
+        """ run one basic block (or a single instruction the compiler leaves
+            to the interpreter, such as a skipped one) and return the number
+            of instructions executed, 0 once the machine has halted """
+        pc = self.regs[REG_PC]
+        if pc == self.last_pc:
+            return 0
+        if not self.skip_next and self.tracer is None:
+            block = self._block(pc)
+            if block is not None:
+                return block[0](self, self.regs, self.memory, self.code_map, self.dirty)
+        return 1 if self.step() else 0
+
+    def run(self, max_cycles, breakpoints=()):
+        """ DCPU.run, a block at a time.  Blocks that could cross the cycle
+            budget or a breakpoint are interpreted instead, so the machine
+            stops in exactly the same state as the interpreter would.  A
+            traced machine is always interpreted. """
+        if self.tracer is not None:
+            return DCPU.run(self, max_cycles, breakpoints)
+        regs = self.regs
+        start = self.cycles
+        limit = start + max_cycles
+        first = True
+        try:
+            while self.cycles < limit:
+                pc = regs[REG_PC]
+                if pc == self.last_pc:
+                    return (STOP_HALT, self.cycles - start, None)
+                if not first and pc in breakpoints:
+                    return (STOP_BREAKPOINT, self.cycles - start, pc)
+                first = False
+                block = None if self.skip_next else self._block(pc)
+                if block is not None and self.cycles + block[3][-2] < limit and \
+                        not (breakpoints and any(x in breakpoints for x in block[2][1:])):
+                    count = block[0](self, regs, self.memory, self.code_map, self.dirty)
+                    self.cycles += block[3][count]
+                    if self.skip_next:
+                        self.cycles += 1
+                else:
+                    self._run(limit - self.cycles, 1, ())
+        except Exception as e:
+            return (STOP_FAULT, self.cycles - start, str(e))
+        return (STOP_CYCLES, self.cycles - start, None)
+
+def _run_blocks(dcpu, limit=20000):
+    """ run blocks until halt, fault or at least limit instructions;
+        returns (instructions run, whether it stopped, fault message) """
+    count = 0
+    try:
+        while count < limit:
+            n = dcpu.step_block()
+            if not n:
+                return (count, True, None)
+            count += n
+    except Exception as e:
+        return (count, True, str(e))
+    return (count, False, None)
+
+def _state(dcpu):
+    return (list(dcpu.regs), dcpu.memory.tostring(), dcpu.skip_next, dcpu.last_pc, dcpu.dirty_pages())
+
+def test_blocks():
+    """ every case must reach the same state under both engines after the
+        same number of instructions """
+    for case in block_cases:
+        prog = load_case(case)
+        compiled = BlockDCPU()
+        compiled.load_program(prog)
+        count, stopped, fault = _run_blocks(compiled)
+        actual = _state(compiled) + (stopped, fault)
+        interpreted = DCPU()
+        interpreted.load_program(prog)
+        for i in xrange(count):
+            interpreted.step()
+        stopped, fault = False, None
+        if actual[-2]:
+            try:
+                stopped = not interpreted.step()
+            except Exception as e:
+                stopped, fault = True, str(e)
+        expected = _state(interpreted) + (stopped, fault)
+        print "--------"
+        print "CASE", case, count
+        print "EXPECTED", expected[0], expected[2:]
+        print "ACTUAL  ", actual[0], actual[2:]
+        assert expected == actual
+
+def test_block_run():
+    """ run must stop in the same state under both engines """
+    cases = [(case, max_cycles, ()) for case in block_cases for max_cycles in (1, 7, 100, 100000)]
+    cases += [(case[0], case[1], case[2]) for case in run_cases]
+    for case in cases:
+        source, max_cycles, breakpoints = case
+        prog = load_case(source)
+        interpreted = DCPU()
+        interpreted.load_program(prog)
+        expected = interpreted.run(max_cycles, breakpoints)
+        compiled = BlockDCPU()
+        compiled.load_program(prog)
+        actual = compiled.run(max_cycles, breakpoints)
+        print "--------"
+        print "CASE", source, max_cycles, breakpoints
+        print "EXPECTED", expected
+        print "ACTUAL  ", actual
+        assert expected == actual
+        assert _state(interpreted) == _state(compiled)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        dcpu = BlockDCPU()
+        with open(sys.argv[1], 'rb') as f:
+            dcpu.load_image(f)
+        print dcpu.run(10000000)
+        print dcpu
+        sys.exit()
+    test_blocks()
+    test_block_run()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from array import array
+from common import *
+
+# Instruction decoding shared by the disassembler and the emulator.  Every
+# possible first word is decoded once, into a table indexed by the word, so
+# decoding an instruction is a few array lookups instead of masks, shifts and
+# dictionary lookups.  The table keeps one byte array per field (512K in
+# all) rather than an object per word.  The arrays are built by repeating
+# short runs rather than decoding word by word, so the first use costs
+# about 2ms, and the table is then shared by everything in the process.
+
+# Operand codes that consume the next word: [next word + register],
+# [next word] and next word (literal)
+OPERAND_WORDS = [1 if 0x10 <= x <= 0x17 or x in (0x1e, 0x1f) else 0 for x in xrange(0x40)]
+
+# Cycles each opcode takes before the cost of its operands; every operand
+# that reads the next word adds one more, and a failed IF* adds one
+BASIC_CYCLES = [0, 1, 2, 2, 2, 3, 3, 2, 2, 1, 1, 1, 2, 2, 2, 2]
+NONBASIC_CYCLES = [0] * 0x40
+NONBASIC_CYCLES[REVERSE_NONOPLOOKUP["JSR"]] = 2
+
+# Operand code to (token type, token value, whether it reads the next
+# word), as the parser names them.  For lit+reg the value is the register;
+# the next word supplies the rest.
+OPERAND_TOKENS = [("regname", REGLOOKUP[x], 0) for x in xrange(0x8)] + \
+                 [("regval", REGLOOKUP[x], 0) for x in xrange(0x8)] + \
+                 [("lit+reg", REGLOOKUP[x], 1) for x in xrange(0x8)] + \
+                 [("popname", "POP", 0), ("peekname", "PEEK", 0), ("pushname", "PUSH", 0),
+                  ("spname", "SP", 0), ("pcname", "PC", 0), ("oname", "O", 0),
+                  ("address", None, 1), ("literal", None, 1)] + \
+                 [("literal", x, 0) for x in xrange(0x20)]
+
+# Mnemonics by the index the table stores; 0 is for words that are not
+# instructions
+NAMES = [None] + OPCODES[1:] + NONOPCODES
+
+class DecodeTable(object):
+    """ the decoding of every first word w, a field per array:
+        op[w] is the basic opcode (0 for non-basic ones, whose opcode is in
+        a), a[w] and b[w] the operand codes, a_words[w] and b_words[w] the
+        next words each operand reads, length[w] the total, cycles[w] the
+        cost leaving out the extra one a failed IF* costs, and
+        NAMES[name[w]] the mnemonic, or None for words that are not
+        instructions. """
+    def __init__(self):
+        # a word is op | a << 4 | b << 10: what depends on op and a repeats
+        # every 0x400 words, and b is the same throughout each 0x400
+        low = xrange(0x400)
+        ops = [word & 0xf for word in low]
+        a_codes = [word >> 4 for word in low]
+        a_words = [OPERAND_WORDS[a] if op else 0 for op, a in zip(ops, a_codes)]
+        costs = [BASIC_CYCLES[op] if op else NONBASIC_CYCLES[a] for op, a in zip(ops, a_codes)]
+        names = [op if op else len(OPCODES) + a if a in NONOPLOOKUP else 0
+                 for op, a in zip(ops, a_codes)]
+        # length and cycles for a b operand that reads no word, then one
+        lengths = [array('B', [1 + n + b_words for n in a_words]) for b_words in (0, 1)]
+        cycles = [array('B', [cost + n + b_words for cost, n in zip(costs, a_words)])
+                  for b_words in (0, 1)]
+        self.op = array('B', ops) * 0x40
+        self.a = array('B', a_codes) * 0x40
+        self.a_words = array('B', a_words) * 0x40
+        self.name = array('B', names) * 0x40
+        self.b, self.b_words, self.length, self.cycles = [array('B') for i in xrange(4)]
+        for b in xrange(0x40):
+            b_words = OPERAND_WORDS[b]
+            self.b.extend(array('B', [b]) * 0x400)
+            self.b_words.extend(array('B', [b_words]) * 0x400)
+            self.length.extend(lengths[b_words])
+            self.cycles.extend(cycles[b_words])
+
+    def entry(self, word):
+        """ (op, a, b, a_words, b_words, length, cycles, name) for word """
+        return (self.op[word], self.a[word], self.b[word], self.a_words[word],
+                self.b_words[word], self.length[word], self.cycles[word],
+                NAMES[self.name[word]])
+
+_table = []
+
+def decode_table():
+    """ the DecodeTable, built on first use """
+    if not _table:
+        _table.append(DecodeTable())
+    return _table[0]
+
+def test_decode():
+    """ the table must agree with decoding each word by hand """
+    table = decode_table()
+    assert len(table.op) == 0x10000 and decode_table() is table
+    for word in xrange(0x10000):
+        op, a, b, a_words, b_words, length, cycles, name = table.entry(word)
+        assert word == op | (a << 4) | (b << 10)
+        assert length == 1 + a_words + b_words
+        if op:
+            assert name == OPLOOKUP[op]
+        else:
+            assert name == NONOPLOOKUP.get(a)
+    assert table.entry(0x7c01) == (0x1, 0x0, 0x1f, 0, 1, 2, 2, "SET")
+    assert table.entry(0x7de1) == (0x1, 0x1e, 0x1f, 1, 1, 3, 3, "SET")
+    assert table.entry(0x7c10) == (0x0, 0x1, 0x1f, 0, 1, 2, 3, "JSR")
+    assert table.entry(0x0020)[7] is None
+    size = sum(len(field) * field.itemsize for field in
+               (table.op, table.a, table.b, table.a_words, table.b_words,
+                table.length, table.cycles, table.name))
+    print "--------"
+    print "DECODE", len(table.op), "words in", size, "bytes"
+
+if __name__ == "__main__":
+    test_decode()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import struct
 from common import *
+from decode import NAMES, OPERAND_TOKENS, decode_table
+from image import read_words
 
 # A simple disassembler for DCPU-16 programs.
 
@@ -59,86 +60,63 @@ def pretty_one(part):
     else:
         return "0x%x" % part[1]
 
+def _trim(pieces, n):
+    """ drop the last n characters from a list of string pieces """
+    while n and pieces:
+        last = pieces.pop()
+        if len(last) > n:
+            pieces.append(last[:-n])
+            n = 0
+        else:
+            n -= len(last)
+
 def pretty_join_typed_tokens(parts):
     """ Join a stream of typed tokens into a pretty string """
     expect_op = True
-    s = ""
+    pieces = []
     for part in parts:
         if part[0] == "newline":
             expect_op = True
-            s = s[:-2]
-            s += "\n"
+            _trim(pieces, 2)
+            pieces.append("\n")
         elif part[0] == "data":
             expect_op = True
-            s += "DAT "+pretty_one(part)+"\n"
+            pieces.append("DAT "+pretty_one(part)+"\n")
         elif expect_op:
-            s += pretty_one(part)+" "
+            pieces.append(pretty_one(part)+" ")
             expect_op = False
         else:
-            s += pretty_one(part)+", "
-    return s[:-1]
-
-def lookup_value(val, iterator, offset):
-    """ lookup may involve consuming the next word from the byte stream
-        returns pair of (token type, token value) """
-    if 0x0 <= val <= 0x7:
-        return ("regname", REGLOOKUP[val], offset)
-    elif 0x08 <= val <= 0x0f:
-        return ("regval", REGLOOKUP[val - 0x08], offset)
-    elif 0x10 <= val <= 0x17:
-        return ("lit+reg", (iterator.next(), REGLOOKUP[val - 0x10]), offset + 1)
-    elif val == 0x18:
-        return ("popname", "POP", offset)
-    elif val == 0x19:
-        return ("peekname", "PEEK", offset)
-    elif val == 0x1a:
-        return ("pushname", "PUSH", offset)
-    elif val == 0x1b:
-        return ("spname", "SP", offset)
-    elif val == 0x1c:
-        return ("pcname", "PC", offset)
-    elif val == 0x1d:
-        return ("oname", "O", offset)
-    elif val == 0x1e:
-        return ("address", iterator.next(), offset + 1)
-    elif val == 0x1f:
-        return ("literal", iterator.next(), offset + 1)
-    elif 0x20 <= val <= 0x3f:
-        return ("literal", val - 0x20, offset)
-    else:
-        raise Exception("NI: 0x%x" % val)
+            pieces.append(pretty_one(part)+", ")
+    _trim(pieces, 1)
+    return "".join(pieces)
 
 def decompile(iterator):
     """ decompile parses a DCPU-16 program byte array into a stream of
         (type, value) entities
         yields all the typed tokens of a stream of instructions """
-    iterator = iter(iterator)
+    next_word = iter(iterator).next
+    table = decode_table()
+    ops, a_codes, b_codes, names = table.op, table.a, table.b, table.name
     offset = 0
     try:
         while True:
-            first_inst = iterator.next()
-            op = OPLOOKUP[0x000f & first_inst]
-            skip = False
-            if op == "NON":
-                skip = True
-                try:
-                    op = NONOPLOOKUP[(0x03f0 & first_inst) >> 4]
-                except KeyError:
+            first_inst = next_word()
+            name = NAMES[names[first_inst]]
+            if name is None:
+                offset += 1
+                yield ("data", [first_inst], offset)
+                continue
+            yield ("op", name, offset)
+            # operands, straight from OPERAND_TOKENS
+            b = b_codes[first_inst]
+            for code in (a_codes[first_inst], b) if ops[first_inst] else (b,):
+                kind, value, words = OPERAND_TOKENS[code]
+                if not words:
+                    yield (kind, value, offset)
+                else:
                     offset += 1
-                    yield ("data", [first_inst], offset)
-                    continue
-            yield ("op", op, offset)
-            if not skip:             
-                val = (0x03f0 & first_inst) >> 4
-                #print "%x" % val
-                tup = lookup_value(val, iterator, offset)
-                offset = tup[2]
-                yield tup
-            val2 = (0xfc00 & first_inst) >> 10
-            #print "%x" % val2
-            tup = lookup_value(val2, iterator, offset)
-            offset = tup[2]
-            yield tup
+                    word = next_word()
+                    yield (kind, (word, value) if kind == "lit+reg" else word, offset)
             yield ("newline", "\n", offset)
             offset += 1
     except StopIteration:
@@ -153,6 +131,40 @@ def decompile_instructions(insts):
     """ return a pretty string decomposition of the given program byte array """
     return pretty_join_typed_tokens(log(i) for i in decompile(insts))
 
+def decompile_lines(insts, addresses=False, raw=False):
+    """ yields the disassembly one line per instruction, as it is decoded,
+        optionally prefixed with its address and the words it came from """
+    consumed = []
+    def recorded():
+        for word in insts:
+            consumed.append(word)
+            yield word
+    addr = 0
+    parts = []
+    for part in decompile(recorded()):
+        parts.append(part)
+        if part[0] == "newline" or part[0] == "data":
+            yield format_line(addr, consumed, parts, addresses, raw)
+            addr += len(consumed)
+            del consumed[:]
+            del parts[:]
+    if parts:
+        # an instruction cut short by the end of the image
+        yield format_line(addr, consumed, parts, addresses, raw)
+
+def format_line(addr, words, parts, addresses, raw):
+    line = pretty_join_typed_tokens(parts)
+    if raw:
+        line = "%-15s %s" % (" ".join("%04x" % w for w in words), line)
+    if addresses:
+        line = "0x%04x: %s" % (addr, line)
+    return line
+
+def write_disassembly(f, insts, addresses=False, raw=False):
+    """ write the disassembly of insts to f a line at a time """
+    for line in decompile_lines(insts, addresses, raw):
+        f.write(line+"\n")
+
 def test_decompilation():
     """ run our test cases """
     for case in decompilation_cases:
@@ -163,18 +175,39 @@ def test_decompilation():
         print "EXPECTED", expected
         print "ACTUAL  ", actual
         assert expected == actual
+        assert "\n".join(decompile_lines(instructions)) == expected
 
-def read_words(f):
-    word = f.read(2)
-    while word != "":
-        yield struct.unpack('>H', word)[0]
-        word = f.read(2)
+def test_streaming():
+    """ the line at a time disassembly must match the whole-string one, and
+        its addresses and raw words must cover the image exactly """
+    import random
+    from image import read_image
+    rng = random.Random(14)
+    images = [[rng.randint(0, 0xffff) for i in xrange(5000)], [0x7c01], [0x0000, 0x7de1, 0x1000]]
+    for name in ["fib.dexe", "notch.dexe", "dcpu16os.dexe"]:
+        with open(name, 'rb') as f:
+            images.append(list(read_image(f)))
+    for words in images:
+        assert "\n".join(decompile_lines(words)) == decompile_instructions(words)
+        addr = 0
+        rebuilt = []
+        for line in decompile_lines(iter(words), addresses=True, raw=True):
+            assert int(line[:6], 16) == addr
+            raw = line[8:23].split()
+            rebuilt.extend(int(w, 16) for w in raw)
+            addr += len(raw)
+        assert rebuilt == words
+    print "--------"
+    print "\n".join(decompile_lines(images[-1][:8], addresses=True, raw=True))
 
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
         with open(sys.argv[1], 'rb') as f:
-            print decompile_instructions(read_words(f))
+            # disassembler.py [exe] [--addresses] [--raw]
+            write_disassembly(sys.stdout, read_words(f),
+                              "--addresses" in sys.argv, "--raw" in sys.argv)
             sys.exit()
     test_decompilation()
+    test_streaming()
 
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import sys
+from array import array
+from bisect import bisect_right
 from common import *
-from disassembler import read_words, decompile
+from decode import OPERAND_WORDS, BASIC_CYCLES, NONBASIC_CYCLES, decode_table
+from image import read_image
 from assembler import assemble
 
 emu_cases = [
@@ -17,25 +21,288 @@ emu_cases = [
     ["SET B, 0x5\nMOD B, 0x3", 2, lambda s: s.registers["B"] == 0x2 and s.registers["O"] == 0 ],
     ["SET B, 0x0\nMOD B, 0x3", 2, lambda s: s.registers["B"] == 0 and s.registers["O"] == 0 ],
     ["SET B, 0x2\nSHL B, 0x1", 2, lambda s: s.registers["B"] == 0x4 and s.registers["O"] == 0],
-    ["SET B, 0x2\nSHR B, 0x1", 2, lambda s: s.registers["B"] == 0x1 and s.registers["O"] == 0]
+    ["SET B, 0x2\nSHR B, 0x1", 2, lambda s: s.registers["B"] == 0x1 and s.registers["O"] == 0],
+    [":loop SET B, 0x2\nADD A, B\nSET [0x0], 0x8c11\nSET PC, loop", 6, lambda s: s.registers["A"] == 0x5],
+    ["SET B, 0x5\nDIV B, 0x0", 2, lambda s: s.registers["B"] == 0 and s.registers["O"] == 0 ],
+    ["SET PUSH, 0x5\nSET A, POP", 2, lambda s: s.registers["A"] == 0x5 and s.registers["SP"] == 0xffff ],
+    ["IFE 0x1, 0x2\nSET A, 0x1\nSET B, 0x1", 3, lambda s: s.registers["A"] == 0 and s.registers["B"] == 0x1 ],
+    ["SET A, 0xffff\nSET [0x1001+A], 0x7", 2, lambda s: s.memory[0x1000] == 0x7 ]
 ]
 
+# A fresh 64K-word address space; machines copy it rather than build one
+ZERO_MEMORY = array('H', [0]) * 0x10000
+
+# Memory is tracked for writes in pages of PAGE_SIZE words
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGES = 0x10000 >> PAGE_BITS
+ZERO_PAGE = array('H', [0]) * PAGE_SIZE
+CLEAN_PAGES = bytearray(PAGES)
+
+# Register file slots: A B C X Y Z I J are 0-7, as in the instruction word
+REG_SP = 8
+REG_PC = 9
+REG_O = 10
+
+REGISTER_NAMES = REGISTERS + ["SP", "PC", "O"]
+REGISTER_INDEX = make_reverse_lookup(REGISTER_NAMES)
+
+# Reasons DCPU.run stops
+STOP_CYCLES = "cycles"
+STOP_HALT = "halt"
+STOP_BREAKPOINT = "breakpoint"
+STOP_FAULT = "fault"
+
+# Operands resolve to a (container, index) location, either into the
+# register file or into memory.  Literals get a throwaway container so
+# writes to them fail silently, as the spec requires.
+
+def _operand_register(cpu, code, word):
+    return cpu.regs, code
+
+def _operand_register_value(cpu, code, word):
+    return cpu.memory, cpu.regs[code - 0x08]
+
+def _operand_register_offset(cpu, code, word):
+    return cpu.memory, (cpu.regs[code - 0x10] + word) & 0xffff
+
+def _operand_pop(cpu, code, word):
+    # the stack pointer always addresses the next free slot
+    sp = (cpu.regs[REG_SP] + 1) & 0xffff
+    cpu.regs[REG_SP] = sp
+    return cpu.memory, sp
+
+def _operand_peek(cpu, code, word):
+    return cpu.memory, (cpu.regs[REG_SP] + 1) & 0xffff
+
+def _operand_push(cpu, code, word):
+    sp = cpu.regs[REG_SP]
+    cpu.regs[REG_SP] = (sp - 1) & 0xffff
+    return cpu.memory, sp
+
+def _operand_sp(cpu, code, word):
+    return cpu.regs, REG_SP
+
+def _operand_pc(cpu, code, word):
+    return cpu.regs, REG_PC
+
+def _operand_o(cpu, code, word):
+    return cpu.regs, REG_O
+
+def _operand_address(cpu, code, word):
+    return cpu.memory, word
+
+def _operand_literal(cpu, code, word):
+    return [word], 0
+
+def _operand_short_literal(cpu, code, word):
+    return [code - 0x20], 0
+
+OPERANDS = [_operand_register] * 0x08 + \
+           [_operand_register_value] * 0x08 + \
+           [_operand_register_offset] * 0x08 + \
+           [_operand_pop, _operand_peek, _operand_push, _operand_sp,
+            _operand_pc, _operand_o, _operand_address, _operand_literal] + \
+           [_operand_short_literal] * 0x20
+
+# Basic opcode handlers take the values of a and b and return the new
+# value of a, or None if a is left alone.
+#
+# 0x1: SET a, b - sets a to b
+# 0x2: ADD a, b - sets a to a+b, sets O to 0x0001 if there's an overflow, 0x0 otherwise
+# 0x3: SUB a, b - sets a to a-b, sets O to 0xffff if there's an underflow, 0x0 otherwise
+# 0x4: MUL a, b - sets a to a*b, sets O to ((a*b)>>16)&0xffff
+# 0x5: DIV a, b - sets a to a/b, sets O to ((a<<16)/b)&0xffff. if b==0, sets a and O to 0 instead.
+# 0x6: MOD a, b - sets a to a%b. if b==0, sets a to 0 instead.
+# 0x7: SHL a, b - sets a to a<<b, sets O to ((a<<b)>>16)&0xffff
+# 0x8: SHR a, b - sets a to a>>b, sets O to ((a<<16)>>b)&0xffff
+# 0x9: AND a, b - sets a to a&b
+# 0xa: BOR a, b - sets a to a|b
+# 0xb: XOR a, b - sets a to a^b
+# 0xc-0xf: IFE, IFN, IFG, IFB - perform next instruction only if the test passes
+
+def _op_set(cpu, a, b):
+    return b
+
+def _op_add(cpu, a, b):
+    x = a + b
+    cpu.regs[REG_O] = x >> 16
+    return x & 0xffff
+
+def _op_sub(cpu, a, b):
+    x = a - b
+    cpu.regs[REG_O] = 0xffff if x < 0 else 0
+    return x & 0xffff
+
+def _op_mul(cpu, a, b):
+    x = a * b
+    cpu.regs[REG_O] = (x >> 16) & 0xffff
+    return x & 0xffff
+
+def _op_div(cpu, a, b):
+    if b == 0:
+        cpu.regs[REG_O] = 0
+        return 0
+    cpu.regs[REG_O] = ((a << 16) / b) & 0xffff
+    return a / b
+
+def _op_mod(cpu, a, b):
+    if b == 0:
+        return 0
+    return a % b
+
+def _op_shl(cpu, a, b):
+    x = a << b
+    cpu.regs[REG_O] = (x >> 16) & 0xffff
+    return x & 0xffff
+
+def _op_shr(cpu, a, b):
+    cpu.regs[REG_O] = ((a << 16) >> b) & 0xffff
+    return a >> b
+
+def _op_and(cpu, a, b):
+    return a & b
+
+def _op_bor(cpu, a, b):
+    return a | b
+
+def _op_xor(cpu, a, b):
+    return a ^ b
+
+def _op_ife(cpu, a, b):
+    cpu.skip_next = a != b
+
+def _op_ifn(cpu, a, b):
+    cpu.skip_next = a == b
+
+def _op_ifg(cpu, a, b):
+    cpu.skip_next = a <= b
+
+def _op_ifb(cpu, a, b):
+    cpu.skip_next = (a & b) == 0
+
+def _op_unknown(cpu, a, b):
+    raise Exception("UNKNOWN OPERATION: NON")
+
+BASIC_OPS = [_op_unknown, _op_set, _op_add, _op_sub, _op_mul, _op_div, _op_mod,
+             _op_shl, _op_shr, _op_and, _op_bor, _op_xor,
+             _op_ife, _op_ifn, _op_ifg, _op_ifb]
+
+# Non-basic opcode handlers take the operand code and its next word
+
+def _nonop_jsr(cpu, code, word):
+    container, index = OPERANDS[code](cpu, code, word)
+    target = container[index]
+    cpu._push(cpu.regs[REG_PC])
+    cpu.regs[REG_PC] = target
+
+def _make_nonop_unknown(opcode):
+    def _nonop_unknown(cpu, code, word):
+        raise Exception("UNKNOWN OPERATION: "+NONOPLOOKUP.get(opcode, "0x%x" % opcode))
+    return _nonop_unknown
+
+NONBASIC_OPS = [_make_nonop_unknown(x) for x in xrange(0x40)]
+NONBASIC_OPS[REVERSE_NONOPLOOKUP["JSR"]] = _nonop_jsr
+
+class RegisterView(object):
+    """ string-keyed view of a DCPU's integer register file """
+    def __init__(self, regs):
+        self.regs = regs
+
+    def __getitem__(self, name):
+        return self.regs[REGISTER_INDEX[name]]
+
+    def __setitem__(self, name, value):
+        self.regs[REGISTER_INDEX[name]] = value
+
+    def keys(self):
+        return list(REGISTER_NAMES)
+
+    def iteritems(self):
+        return ((REGISTER_NAMES[i], self.regs[i]) for i in xrange(len(REGISTER_NAMES)))
+
+# [program source or .dexe, max cycles, breakpoints, expected (reason, cycles, detail)]
+run_cases = [
+    ["SET A, 0x30\nADD A, 0x1\nIFE A, 0x0\nSET B, 0x1\n:halt SET PC, halt", 100, (),
+     (STOP_HALT, 8, None)],
+    ["SET A, 0x30\nADD A, 0x1\nIFE A, 0x0\nSET B, 0x1\n:halt SET PC, halt", 4, (),
+     (STOP_CYCLES, 4, None)],
+    ["SET A, 0x30\nADD A, 0x1\nIFE A, 0x0\nSET B, 0x1\n:halt SET PC, halt", 100, (0x3,),
+     (STOP_BREAKPOINT, 4, 0x3)],
+    ["SET A, 0x30", 100, (), (STOP_FAULT, 2, "UNKNOWN OPERATION: RES")],
+    ["fib.dexe", 100, (), None],
+    ["fib.dexe", 1000000, (), None],
+    ["dcpu16os.dexe", 5000, (0x1e,), None],
+    ["dcpu16os.dexe", 1000000, (), None]
+]
+
+class Snapshot(object):
+    """ a captured DCPU state; pages is a tuple of PAGES page copies that
+        must never be modified, since machines and other snapshots share them """
+    def __init__(self, regs, skip_next, last_pc, cycles, pages):
+        self.regs = regs
+        self.skip_next = skip_next
+        self.last_pc = last_pc
+        self.cycles = cycles
+        self.pages = pages
+
 class DCPU(object):
     def __init__(self):
+        # a tracing.Tracer told about every instruction, or None
+        self.tracer = None
         self.clear()
 
     def clear(self):
-        self.registers = dict((x, 0) for x in "A B C X Y Z I J SP PC O".split())
-        self.memory = [0 for x in xrange(0x10000)]
-        self.registers["SP"] = 0xffff
+        self.regs = [0] * len(REGISTER_NAMES)
+        self.memory = ZERO_MEMORY[:]
+        self.regs[REG_SP] = 0xffff
         self.last_pc = -1
         self.skip_next = False
+        self.cycles = 0
+        self.flush_decoded()
+        # pages written since the last checkpoint
+        self.dirty = bytearray(PAGES)
+        # checkpoint id => (registers, skip_next, last_pc, cycles)
+        self.checkpoints = {}
+        self.next_checkpoint = 0
+        # page => ([checkpoint ids], [copies of the page as of each])
+        self.page_history = {}
+        # each page as of the last checkpoint; copies are never modified, so
+        # snapshots and checkpoints share them
+        self.pages = [ZERO_PAGE] * PAGES
+        self.checkpoint()
+
+    @property
+    def registers(self):
+        return RegisterView(self.regs)
+
+    def flush_decoded(self):
+        """ forget every cached instruction decoding """
+        # address => (op, a, a_word, b, b_word, length, cycles)
+        self.decoded = {}
+        # per-word count of cached instructions covering that word
+        self.code_map = bytearray(0x10000)
 
     def load_program(self, prog):
-        i = 0
-        for word in prog:
-            self.memory[i] = word
-            i += 1
+        """ copy a sequence of words into memory starting at address 0 """
+        if not isinstance(prog, array) or prog.typecode != 'H':
+            prog = array('H', prog)
+        if len(prog) > 0x10000:
+            raise Exception("Program too large: %d words" % len(prog))
+        self.memory[:len(prog)] = prog
+        pages = (len(prog) + PAGE_SIZE - 1) >> PAGE_BITS
+        self.dirty[:pages] = b"\x01" * pages
+        self.flush_decoded()
+
+    def patch(self, addr, words):
+        """ overwrite memory from addr with words while the machine is
+            running, dropping any decodings they make stale """
+        for i, word in enumerate(words):
+            self._write((addr + i) & 0xffff, word)
+
+    def load_image(self, source):
+        """ load a big-endian .dexe image from a file object or byte string """
+        self.load_program(read_image(source))
 
     def __str__(self):
         s = "DCPU\n"
@@ -43,185 +310,277 @@ class DCPU(object):
         for k,v in self.registers.iteritems():
             s += "%s\t=>\t0x%x\n" % (k, v)
         s += "MEMORY\n"
-        for i in xrange(0x10000/8):
-            st = i*8
-            m = self.memory[st:st+8]
-            if any(m):
-                s += "0x%x\t%s\n" % (st, ["0x%4x" % x for x in m])
+        for page in self.touched_pages():
+            for st in xrange(page << PAGE_BITS, (page + 1) << PAGE_BITS, 8):
+                m = self.memory[st:st+8]
+                if any(m):
+                    s += "0x%x\t%s\n" % (st, ["0x%4x" % x for x in m])
         return s
 
-    def _raise(self, msg):
-        raise Exception(msg)
-
-    def _target(self, op, container, index, val):
-        """
-        0x1: SET a, b - sets a to b
-        0x2: ADD a, b - sets a to a+b, sets O to 0x0001 if there's an overflow, 0x0 otherwise
-        0x3: SUB a, b - sets a to a-b, sets O to 0xffff if there's an underflow, 0x0 otherwise
-        0x4: MUL a, b - sets a to a*b, sets O to ((a*b)>>16)&0xffff
-        0x5: DIV a, b - sets a to a/b, sets O to ((a<<16)/b)&0xffff. if b==0, sets a and O to 0 instead.
-        0x6: MOD a, b - sets a to a%b. if b==0, sets a to 0 instead.
-        0x7: SHL a, b - sets a to a<<b, sets O to ((a<<b)>>16)&0xffff
-        0x8: SHR a, b - sets a to a>>b, sets O to ((a<<16)>>b)&0xffff
-        0x9: AND a, b - sets a to a&b
-        0xa: BOR a, b - sets a to a|b
-        0xb: XOR a, b - sets a to a^b
-        """
-        if op == "SET":
-            container[index] = val
-        elif op == "ADD":
-            container[index] += val
-            if container[index] > 0xffff:
-                container[index] -= 0x10000
-                self.registers["O"] = 0x1
-            else:
-                self.registers["O"] = 0
-        elif op == "SUB":
-            container[index] -= val
-            if container[index] < 0:
-                container[index] += 0x10000;
-                self.registers["O"] = 0xffff
-            else:
-                self.registers["O"] = 0
-        elif op == "MUL":
-            x = container[index] * val
-            container[index] = x & 0xffff
-            self.registers["O"] = (x >> 16) & 0xffff
-        elif op == "DIV":
-            if container[index] == 0:
-                container[index] = 0
-                self.registers["O"] = 0
-            else:
-                x = container[index] / val
-                o = ((container[index] << 16) / val) & 0xffff
-                container[index] = x
-                self.registers["O"] = o
-        elif op == "MOD":
-            if container[index] == 0:
-                container[index] = 0
-                self.registers["O"] = 0
+    def dirty_pages(self):
+        """ pages written since the last checkpoint """
+        return [page for page in xrange(PAGES) if self.dirty[page]]
+
+    def touched_pages(self):
+        """ pages written at any point since the machine was cleared; every
+            other page is still zero """
+        pages = set(self.page_history)
+        pages.update(self.dirty_pages())
+        return sorted(pages)
+
+    def checkpoint(self):
+        """ record the registers and copy the pages written since the last
+            checkpoint, then start tracking writes afresh.  Returns the id to
+            hand to changed_words. """
+        cid = self.next_checkpoint
+        self.next_checkpoint += 1
+        self.checkpoints[cid] = (tuple(self.regs), self.skip_next, self.last_pc, self.cycles)
+        for page in self.dirty_pages():
+            start = page << PAGE_BITS
+            self._commit_page(cid, page, self.memory[start:start + PAGE_SIZE])
+        self.dirty[:] = CLEAN_PAGES
+        return cid
+
+    def _commit_page(self, cid, page, copy):
+        ids, copies = self.page_history.setdefault(page, ([], []))
+        ids.append(cid)
+        copies.append(copy)
+        self.pages[page] = copy
+
+    def discard(self, before):
+        """ forget every checkpoint older than before, along with the page
+            copies only they needed.  Snapshots keep their own pages. """
+        for cid in [cid for cid in self.checkpoints if cid < before]:
+            del self.checkpoints[cid]
+        for ids, copies in self.page_history.itervalues():
+            # the copy in force at before is still needed
+            i = bisect_right(ids, before) - 1
+            if i > 0:
+                del ids[:i]
+                del copies[:i]
+
+    def _check_checkpoint(self, cid):
+        if cid not in self.checkpoints:
+            raise Exception("Unknown checkpoint: %r" % cid)
+
+    def snapshot(self):
+        """ capture the machine as a Snapshot.  This is also a checkpoint, so
+            only pages written since the last one are copied; the rest are
+            shared with earlier checkpoints and snapshots. """
+        self.checkpoint()
+        return Snapshot(tuple(self.regs), self.skip_next, self.last_pc, self.cycles, tuple(self.pages))
+
+    def restore(self, snap):
+        """ put the machine back in the state of snap, copying only the
+            pages that differ from it.  Restoring is recorded as a checkpoint. """
+        cid = self.next_checkpoint
+        self.next_checkpoint += 1
+        for page in xrange(PAGES):
+            copy = snap.pages[page]
+            if self.dirty[page] or self.pages[page] is not copy:
+                start = page << PAGE_BITS
+                self.memory[start:start + PAGE_SIZE] = copy
+                self._commit_page(cid, page, copy)
+                if any(self.code_map[start:start + PAGE_SIZE]):
+                    for addr in xrange(start, start + PAGE_SIZE):
+                        if self.code_map[addr]:
+                            self._invalidate(addr)
+        self.dirty[:] = CLEAN_PAGES
+        self.regs[:] = snap.regs
+        self.skip_next = snap.skip_next
+        self.last_pc = snap.last_pc
+        self.cycles = snap.cycles
+        self.checkpoints[cid] = (snap.regs, snap.skip_next, snap.last_pc, snap.cycles)
+
+    def fork(self, snap=None):
+        """ a new, independent machine of the same kind in the state of snap,
+            or of this machine right now """
+        if snap is None:
+            snap = self.snapshot()
+        dcpu = self.__class__()
+        dcpu.restore(snap)
+        return dcpu
+
+    def page_at(self, page, cid):
+        """ the contents of a page as of checkpoint cid """
+        self._check_checkpoint(cid)
+        history = self.page_history.get(page)
+        if history is not None:
+            i = bisect_right(history[0], cid)
+            if i:
+                return history[1][i - 1]
+        return ZERO_PAGE
+
+    def changed_words(self, since, until=None):
+        """ [(address, old, new)] for every word that differs between
+            checkpoint since and checkpoint until (or the live machine), only
+            looking at pages written in between """
+        self._check_checkpoint(since)
+        if until is not None:
+            self._check_checkpoint(until)
+        pages = set()
+        for page, (ids, copies) in self.page_history.iteritems():
+            i = bisect_right(ids, since)
+            if i < len(ids) and (until is None or ids[i] <= until):
+                pages.add(page)
+        if until is None:
+            pages.update(self.dirty_pages())
+        changes = []
+        for page in sorted(pages):
+            old = self.page_at(page, since)
+            if until is None:
+                start = page << PAGE_BITS
+                new = self.memory[start:start + PAGE_SIZE]
             else:
-                container[index] %= val
-        elif op == "SHL":
-            x = (container[index] << val) & 0xffff
-            o = ((container[index] << val) >> 16) & 0xffff
-            container[index] = x
-            self.registers["O"] = o
-        elif op == "SHR":
-            x = (container[index] >> val) & 0xffff
-            o = ((container[index] << 16) >> val) & 0xffff
-            container[index] = x
-            self.registers["O"] = o
-        elif op == "AND":
-            container[index] = (container[index] & val) & 0xffff
-        elif op == "BOR":
-            container[index] = (container[index] | val) & 0xffff
-        elif op == "XOR":
-            container[index] = (container[index] ^ val) & 0xffff
-        elif op not in ["IFE", "IFN", "IFG", "IFB"]:
-            raise Exception("UNKNOWN OPERATION: "+op)
-        return container[index]
-
-    def _run_cond(self, ctype, a, b):
-        if ctype == "IFE":
-            return a == b
-        elif ctype == "IFN":
-            return a != b
-        elif ctype == "IFG":
-            return a > b
-        elif ctype == "IFB":
-            return (a&b) != 0
-        else:
-            raise Exception("Unknown op: "+ctype)
+                new = self.page_at(page, until)
+            if old != new:
+                base = page << PAGE_BITS
+                changes.extend((base + i, old[i], new[i]) for i in xrange(PAGE_SIZE) if old[i] != new[i])
+        return changes
+
+    def _write(self, addr, value):
+        """ store a word in memory, dropping stale decodings it covers """
+        self.memory[addr] = value
+        self.dirty[addr >> PAGE_BITS] = 1
+        if self.code_map[addr]:
+            self._invalidate(addr)
+
+    def _invalidate(self, addr):
+        """ drop the cached decoding of any instruction covering addr """
+        for start in (addr, addr - 1, addr - 2):
+            start &= 0xffff
+            record = self.decoded.get(start)
+            if record is not None and (addr - start) & 0xffff < record[5]:
+                del self.decoded[start]
+                for i in xrange(record[5]):
+                    self.code_map[(start + i) & 0xffff] -= 1
+
+    def _decode(self, addr):
+        """ decode the instruction at addr into a compact record
+            (op, a, a_word, b, b_word, length, cycles) of integer codes, cached
+            per address so memory is never sliced or re-parsed on the hot path.
+            Non-basic instructions have op 0 and their opcode in a. """
+        record = self.decoded.get(addr)
+        if record is None:
+            memory = self.memory
+            table = decode_table()
+            word = memory[addr]
+            op, a, b = table.op[word], table.a[word], table.b[word]
+            a_words, length, cycles = table.a_words[word], table.length[word], table.cycles[word]
+            a_word = memory[(addr + 1) & 0xffff] if a_words else None
+            b_word = memory[(addr + 1 + a_words) & 0xffff] if table.b_words[word] else None
+            record = (op, a, a_word, b, b_word, length, cycles)
+            self.decoded[addr] = record
+            for i in xrange(length):
+                self.code_map[(addr + i) & 0xffff] += 1
+        return record
 
     def _push(self, value):
-        self.memory[self.registers["SP"]] = value
-        self.registers["SP"] -= 1
+        sp = self.regs[REG_SP]
+        self._write(sp, value)
+        self.regs[REG_SP] = (sp - 1) & 0xffff
 
     def _pop(self):
-        self.registers["SP"] += 1
-        v = self.memory[self.registers["SP"]]
-        return v
+        sp = (self.regs[REG_SP] + 1) & 0xffff
+        self.regs[REG_SP] = sp
+        return self.memory[sp]
 
-    def step(self):
-        if self.registers["PC"] == self.last_pc:
-            return False
-        else:
-            self.last_pc = self.registers["PC"]
-        iriter = decompile(self.memory[self.registers["PC"]:])
-        self.registers["PC"] += 1
-
-        op = iriter.next()
-        print "op", op
-
-        target = iriter.next()
-        print "target", target
-        value = iriter.next()
-        print "value", value
-        setter = lambda x: self._raise("setter undefined")
-        getter = lambda: self._raise("getter undefined")
-
-        # fix our PC if we read words to get value
-        self.registers["PC"] += value[-1]
-
-        if self.skip_next:
-            print "SKIPPED"
-            self.skip_next = False
-        elif op[1] == "JSR":
-            self._push(self.registers["PC"])
-            self.registers["PC"] = target[1]
-        else:
-            if target[0] == "regname":
-                setter = lambda x: self._target(op[1], self.registers, target[1], x)
-            elif target[0] == "regval":
-                setter = lambda x: self._target(op[1], self.memory, self.registers[target[1]], x)
-            elif target[0] == "address":
-                setter = lambda x: self._target(op[1], self.memory, target[1], x)
-            elif target[0] == "lit+reg":
-                setter = lambda x: self._target(op[1], self.memory, self.registers[target[1][1]] + target[1][0], x)
-            elif target[0] == "pcname":
-                setter = lambda x: self._target(op[1], self.registers, "PC", x)
-            elif target[0] == "pushname":
-                self.registers["SP"] -= 1
-                setter = lambda x: self._target(op[1], self.memory, self.registers["SP"]+1, x)
-            else:
-                raise Exception("Unknown target: "+str(target))
-
-            if value[0] == "literal":
-                getter = lambda: value[1]
-            elif value[0] == "regname":
-                getter = lambda: self.registers[value[1]]
-            elif value[0] == "regval":
-                getter = lambda: self.memory[self.registers[value[1]]]
-            elif value[0] == "address":
-                getter = lambda: self.memory[value[1]]
-            elif value[0] == "lit+reg":
-                getter = lambda: self.memory[self.registers[value[1][1]] + value[1][0]]
-            elif value[0] == "popname":
-                getter = lambda: self._pop()
-            else:
-                raise Exception("Unkown value: "+str(value))
+    def _run(self, max_cycles, max_steps, breakpoints):
+        """ the interpreter loop behind step and run.  Runs until max_cycles
+            have been spent, max_steps instructions have been executed, the
+            machine halts (PC did not move) or PC reaches a breakpoint after
+            the first instruction, and returns the matching STOP_* reason.
+            Faults propagate from partway through the faulting instruction:
+            PC is already past it, its cycles are counted and its operands'
+            side effects (SP moved by PUSH or POP) have happened. """
+        regs = self.regs
+        memory = self.memory
+        decoded = self.decoded
+        cycles = self.cycles
+        limit = cycles + max_cycles
+        steps = 0
+        try:
+            while cycles < limit and steps < max_steps:
+                pc = regs[REG_PC]
+                if pc == self.last_pc:
+                    return STOP_HALT
+                if steps and pc in breakpoints:
+                    return STOP_BREAKPOINT
+                self.last_pc = pc
+                steps += 1
+                record = decoded.get(pc)
+                if record is None:
+                    record = self._decode(pc)
+                op, a, a_word, b, b_word, length, cost = record
+
+                regs[REG_PC] = (pc + length) & 0xffff
+
+                if self.skip_next:
+                    self.skip_next = False
+                    continue
+                cycles += cost
+                if op:
+                    container, index = OPERANDS[a](self, a, a_word)
+                    value_container, value_index = OPERANDS[b](self, b, b_word)
+                    result = BASIC_OPS[op](self, container[index], value_container[value_index])
+                    if result is not None:
+                        if container is memory:
+                            self._write(index, result)
+                        else:
+                            container[index] = result
+                    elif self.skip_next:
+                        cycles += 1
+                else:
+                    NONBASIC_OPS[a](self, b, b_word)
+            return STOP_CYCLES
+        finally:
+            self.cycles = cycles
+
+    def _run_traced(self, max_cycles, max_steps, breakpoints):
+        """ _run one instruction at a time, telling the tracer about each """
+        limit = self.cycles + max_cycles
+        steps = 0
+        while self.cycles < limit and steps < max_steps:
+            pc = self.regs[REG_PC]
+            if pc == self.last_pc:
+                return STOP_HALT
+            if steps and pc in breakpoints:
+                return STOP_BREAKPOINT
+            self.tracer.instruction(pc, self._decode(pc), self.skip_next)
+            self._run(limit - self.cycles, 1, ())
+            steps += 1
+        return STOP_CYCLES
 
-            had_gotten = getter()
-            had_set = setter(had_gotten)
+    def _execute(self, max_cycles, max_steps, breakpoints):
+        if self.tracer is None:
+            return self._run(max_cycles, max_steps, breakpoints)
+        return self._run_traced(max_cycles, max_steps, breakpoints)
 
-            if op[1] in ["IFE", "IFN", "IFG", "IFB"]:
-                cond_true = self._run_cond(op[1], had_set, had_gotten)
-                if not cond_true:
-                    self.skip_next = True
+    def step(self):
+        """ execute one instruction; returns False once the machine halts """
+        return self._execute(1, 1, ()) != STOP_HALT
 
-        return True
+    def run(self, max_cycles, breakpoints=()):
+        """ execute instructions until at least max_cycles cycles have been
+            spent, with the same results as stepping one at a time.  Returns
+            (reason, cycles, detail): reason is one of the STOP_* values and
+            detail is the breakpoint address or the fault message. """
+        start = self.cycles
+        detail = None
+        try:
+            reason = self._execute(max_cycles, sys.maxint, breakpoints)
+            if reason == STOP_BREAKPOINT:
+                detail = self.regs[REG_PC]
+        except Exception as e:
+            reason, detail = STOP_FAULT, str(e)
+        return (reason, self.cycles - start, detail)
 
-def run_emu(prog, steps):
+def run_emu(prog, steps, tracer=None):
     dcpu = DCPU()
+    dcpu.tracer = tracer
     dcpu.load_program(prog)
-    print "STEP 0"
-    print dcpu
     for i in xrange(steps):
-        print "STEP", i+1
         if not dcpu.step(): break
-        print dcpu
-    print dcpu
     return dcpu
 
 def test_emu_cases():
@@ -231,13 +590,117 @@ def test_emu_cases():
         dcpu = run_emu(prog, steps)
         assert predicate(dcpu)
 
+def load_case(case):
+    """ a program from either assembly source or a .dexe file name """
+    if case.endswith(".dexe"):
+        with open(case, 'rb') as f:
+            return read_image(f)
+    return list(assemble(case.split("\n")))
+
+def test_run():
+    """ run must stop where stepping would, for the same cycle counts """
+    for case in run_cases:
+        source, max_cycles, breakpoints, expected = case
+        prog = load_case(source)
+        dcpu = DCPU()
+        dcpu.load_program(prog)
+        actual = dcpu.run(max_cycles, breakpoints)
+        stepped = DCPU()
+        stepped.load_program(prog)
+        reason, detail = STOP_CYCLES, None
+        try:
+            while stepped.cycles < max_cycles:
+                if stepped.cycles and stepped.regs[REG_PC] in breakpoints:
+                    reason, detail = STOP_BREAKPOINT, stepped.regs[REG_PC]
+                    break
+                if not stepped.step():
+                    reason = STOP_HALT
+                    break
+        except Exception as e:
+            reason, detail = STOP_FAULT, str(e)
+        print "--------"
+        print "CASE", source, max_cycles, breakpoints
+        print "EXPECTED", expected, (reason, stepped.cycles, detail)
+        print "ACTUAL  ", actual
+        assert expected is None or expected == actual
+        assert actual == (reason, stepped.cycles, detail)
+        assert stepped.regs == dcpu.regs and stepped.memory == dcpu.memory
+
+def test_checkpoints():
+    """ changed_words must agree with comparing full copies of memory """
+    for source in ["fib.dexe", "dcpu16os.dexe"]:
+        dcpu = DCPU()
+        dcpu.load_program(load_case(source))
+        ids = [dcpu.checkpoint()]
+        copies = [dcpu.memory[:]]
+        while dcpu.run(50)[0] == STOP_CYCLES:
+            ids.append(dcpu.checkpoint())
+            copies.append(dcpu.memory[:])
+        pairs = [(0, len(ids) - 1), (0, len(ids) / 2)] + [(i, i + 1) for i in xrange(len(ids) - 1)]
+        for since, until in pairs:
+            old, new = copies[since], copies[until]
+            expected = [(i, old[i], new[i]) for i in xrange(0x10000) if old[i] != new[i]]
+            assert dcpu.changed_words(ids[since], ids[until]) == expected
+        dcpu.run(10)
+        print "--------"
+        print "CASE", source, len(ids), "checkpoints"
+        print "CHANGED", len(dcpu.changed_words(ids[0])), "words"
+        assert dcpu.changed_words(ids[-1]) == []
+        assert len(dcpu.changed_words(ids[0])) == sum(1 for i in xrange(0x10000) if dcpu.memory[i] != copies[0][i])
+        # dropping the older half frees their records and page copies
+        held = sum(len(copies) for ids, copies in dcpu.page_history.itervalues())
+        middle = len(ids) / 2
+        dcpu.discard(ids[middle])
+        kept = sum(len(copies) for ids, copies in dcpu.page_history.itervalues())
+        print "DISCARDED", len(ids) - len(dcpu.checkpoints), "checkpoints,", held - kept, "page copies"
+        assert sorted(dcpu.checkpoints) == ids[middle:]
+        assert kept < held
+        for since, until in [(middle, len(ids) - 1), (middle, middle + 1)]:
+            old, new = copies[since], copies[until]
+            expected = [(i, old[i], new[i]) for i in xrange(0x10000) if old[i] != new[i]]
+            assert dcpu.changed_words(ids[since], ids[until]) == expected
+        try:
+            dcpu.changed_words(ids[0])
+            assert False, "discarded checkpoint used"
+        except Exception as e:
+            assert str(e).startswith("Unknown checkpoint"), e
+
+def test_snapshots():
+    """ restoring or forking a snapshot must replay exactly the same run """
+    cases = [("dcpu16os.dexe", 200),
+             # rewrites its own first instruction after the snapshot
+             (":loop SET B, 0x2\nADD A, B\nSET [0x0], 0x8c11\nSET PC, loop", 2)]
+    for source, warmup in cases:
+        dcpu = DCPU()
+        dcpu.load_program(load_case(source))
+        dcpu.run(warmup)
+        snap = dcpu.snapshot()
+        first = dcpu.run(100000)
+        expected = (list(dcpu.regs), dcpu.memory[:], dcpu.cycles)
+        fork = dcpu.fork(snap)
+        dcpu.restore(snap)
+        assert dcpu.regs == list(snap.regs) and dcpu.cycles == snap.cycles
+        for machine in (dcpu, fork):
+            assert machine.run(100000) == first
+            assert (list(machine.regs), machine.memory[:], machine.cycles) == expected
+        print "--------"
+        print "CASE", source, first
+        restored = dcpu.checkpoint()
+        dcpu.restore(snap)
+        changes = dcpu.changed_words(restored)
+        print "CHANGED", len(changes), "words"
+        assert all(dcpu.memory[addr] == new for addr, old, new in changes)
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
         prog = None
         with open(sys.argv[1], 'rb') as f:
-            prog = list(read_words(f))
-        run_emu(prog, 10000)
+            prog = read_image(f)
+        print run_emu(prog, 10000)
         sys.exit()
     else:
         test_emu_cases()
+        test_run()
+        test_checkpoints()
+        test_snapshots()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import sys
+from array import array
+from itertools import islice
+
+# Reading and writing .dexe images: big-endian 16 bit words, converted in
+# bulk with array and one byteswap per chunk rather than a struct call per
+# word.  The chunked forms never hold more than chunk_words words at a time,
+# so images can be streamed between stages through pipes.
+
+CHUNK_WORDS = 0x8000
+
+def _swap(words):
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
+
+def to_words(data):
+    """ an array('H') from a big-endian byte string """
+    if len(data) % 2 != 0:
+        raise Exception("Odd image length: %d bytes" % len(data))
+    words = array('H')
+    words.fromstring(data)
+    return _swap(words)
+
+def to_bytes(words):
+    """ words as a big-endian byte string """
+    return _swap(array('H', words)).tostring()
+
+def read_image(source):
+    """ read a whole big-endian word image from a file object or byte string
+        into an array('H') with one bulk read and one byte swap """
+    return to_words(source.read() if hasattr(source, "read") else source)
+
+def read_chunks(f, chunk_words=CHUNK_WORDS):
+    """ yields the image in f as array('H') chunks of up to chunk_words
+        words, tolerating the short reads pipes give """
+    size = chunk_words * 2
+    pending = ""
+    total = 0
+    while True:
+        data = f.read(size - len(pending))
+        if not data:
+            break
+        data = pending + data
+        total += len(data) - len(pending)
+        usable = len(data) & ~1
+        pending = data[usable:]
+        if usable:
+            yield to_words(data[:usable])
+    if pending:
+        raise Exception("Odd image length: %d bytes" % total)
+
+def read_words(f, chunk_words=CHUNK_WORDS):
+    """ yields the words of the image in f one at a time, reading in chunks """
+    for chunk in read_chunks(f, chunk_words):
+        for word in chunk:
+            yield word
+
+def write_image(f, words, chunk_words=CHUNK_WORDS):
+    """ write words (any iterable, consumed chunk by chunk) to f as a
+        big-endian image; returns the number of words written """
+    words = iter(words)
+    count = 0
+    while True:
+        chunk = array('H', islice(words, chunk_words))
+        if not chunk:
+            return count
+        f.write(_swap(chunk).tostring())
+        count += len(chunk)
+
+def test_image():
+    """ chunked and whole-image reads and writes must agree byte for byte """
+    import os
+    import random
+    import threading
+    from StringIO import StringIO
+    rng = random.Random(13)
+    words = [rng.randint(0, 0xffff) for i in xrange(1000)] + [0x0000, 0xffff, 0x7c01]
+    expected = "".join(chr(w >> 8) + chr(w & 0xff) for w in words)
+    assert to_bytes(words) == expected
+    assert list(read_image(expected)) == words
+    for chunk_words in (1, 3, 64, CHUNK_WORDS):
+        f = StringIO()
+        assert write_image(f, iter(words), chunk_words) == len(words)
+        assert f.getvalue() == expected
+        chunks = list(read_chunks(StringIO(expected), chunk_words))
+        assert all(len(chunk) <= chunk_words for chunk in chunks)
+        assert list(read_words(StringIO(expected), chunk_words)) == words
+    for bad in ("\x7c", expected + "\x01"):
+        for read in (read_image, lambda data: list(read_words(StringIO(data)))):
+            try:
+                read(bad)
+                assert False, "odd image accepted"
+            except Exception as e:
+                assert str(e).startswith("Odd image length"), e
+    # a pipe hands the reader whatever the writer has sent so far
+    r, w = os.pipe()
+    def dribble():
+        with os.fdopen(w, 'wb', 0) as g:
+            for i in xrange(0, len(expected), 7):
+                g.write(expected[i:i + 7])
+    writer = threading.Thread(target=dribble)
+    writer.start()
+    with os.fdopen(r, 'rb', 0) as f:
+        assert list(read_words(f, 16)) == words
+    writer.join()
+    print "--------"
+    print "IMAGE", len(words), "words round trip"
+
+if __name__ == "__main__":
+    test_image()
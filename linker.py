@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import binascii
+import hashlib
+import json
+import os
+import tempfile
+from array import array
+from common import *
+from parser import parse
+from assembler import compile_ir, resolve_labels, sizing_events
+from image import to_bytes, to_words, write_image
+
+# Separate compilation: each source unit assembles to a relocatable object
+# holding its words, the labels it defines (exports), the labels it uses but
+# doesn't define (imports) and the words that hold a label's address
+# (relocations).  Objects are assembled as if loaded at address 0 with every
+# label reference in the long form, since where they end up isn't known
+# until link time.  link() lays the objects out in order and patches every
+# relocated word.  A label is looked up in its own unit first, so only
+# imports have to be unique across units.
+
+OBJECT_VERSION = 1
+
+class ObjectFile(object):
+    def __init__(self, words, exports, imports, relocations):
+        self.words = array('H', words)
+        self.exports = exports
+        self.imports = imports
+        self.relocations = relocations
+
+    def dumps(self):
+        return json.dumps({"version": OBJECT_VERSION,
+                           "words": binascii.hexlify(to_bytes(self.words)),
+                           "exports": self.exports,
+                           "imports": sorted(self.imports),
+                           "relocations": self.relocations}, sort_keys=True)
+
+    @classmethod
+    def loads(cls, data):
+        obj = json.loads(data)
+        if obj["version"] != OBJECT_VERSION:
+            raise Exception("Unsupported object version: %r" % obj["version"])
+        return cls(to_words(binascii.unhexlify(obj["words"])),
+                   dict((str(name), addr) for name, addr in obj["exports"].iteritems()),
+                   set(str(name) for name in obj["imports"]),
+                   [(addr, str(name)) for addr, name in obj["relocations"]])
+
+def compile_object(source):
+    """ assemble lines of source into a relocatable ObjectFile """
+    ir = list(parse(source))
+    events = sizing_events(ir)
+    defined = set(name for kind, name in events if kind == "define")
+    imports = set(name for kind, name in events if kind == "refer") - defined
+    # a reference to an import is a word whose value the linker fills in
+    exports = resolve_labels([("words", 1) if kind == "refer" and name in imports
+                              else (kind, name) for kind, name in events], False)
+    offsets = dict(exports)
+    offsets.update((name, 0) for name in imports)
+    relocations = []
+    words = compile_ir(ir, short_labels=False, label_offsets=offsets, relocations=relocations)
+    return ObjectFile(words, exports, imports, relocations)
+
+class ObjectCache(object):
+    """ objects on disk in directory, keyed by a hash of their source, so a
+        unit is only assembled again when its text changes """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, source):
+        digest = hashlib.sha1("dcpy object %d\n" % OBJECT_VERSION)
+        for line in source:
+            digest.update(line.rstrip("\n") + "\n")
+        return digest.hexdigest()
+
+    def compile(self, source):
+        """ the object for lines of source, from disk if it was built before """
+        source = list(source)
+        path = os.path.join(self.directory, self.key(source) + ".obj")
+        if os.path.exists(path):
+            self.hits += 1
+            with open(path) as f:
+                return ObjectFile.loads(f.read())
+        self.misses += 1
+        obj = compile_object(source)
+        # write then rename, so a crash never leaves half an object behind;
+        # the temporary name is unique, so concurrent builds don't collide
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(obj.dumps())
+        os.rename(temp, path)
+        return obj
+
+def link(objects):
+    """ (image, symbols): the objects laid out one after another from
+        address 0, with every relocated word patched, and each object's
+        exports at their final addresses (one dict per object) """
+    bases = []
+    base = 0
+    for obj in objects:
+        bases.append(base)
+        base += len(obj.words)
+    if base > 0x10000:
+        raise Exception("Program too large: %d words" % base)
+    providers = {}
+    for obj, base in zip(objects, bases):
+        for name, addr in obj.exports.iteritems():
+            providers.setdefault(name, []).append(base + addr)
+    image = array('H')
+    symbols = []
+    for obj, base in zip(objects, bases):
+        words = array('H', obj.words)
+        for addr, name in obj.relocations:
+            if name in obj.exports:
+                target = base + obj.exports[name]
+            else:
+                found = providers.get(name)
+                if not found:
+                    raise Exception("Undefined symbol: "+name)
+                if len(found) > 1:
+                    raise Exception("Ambiguous symbol: "+name)
+                target = found[0]
+            words[addr] = target & 0xffff
+        image.extend(words)
+        symbols.append(dict((name, base + addr) for name, addr in obj.exports.iteritems()))
+    return image, symbols
+
+def build(sources, cache):
+    """ compile (or fetch) each unit's object and link them in order """
+    return link([cache.compile(source) for source in sources])
+
+def test_linker():
+    """ linking the pieces of a program must give the image assembling it
+        whole does, and unchanged units must come from the cache """
+    import shutil
+    from assembler import assemble
+    from emu import DCPU
+    with open("dcpu16os.dasm") as f:
+        lines = f.readlines()
+    expected = list(assemble(lines, short_labels=False))
+    # the entry jump, the runtime routines and the program as three units
+    video = lines.index(";; video\n")
+    start = lines.index(":start\n")
+    units = [lines[:video], lines[video:start], lines[start:]]
+    scratch = tempfile.mkdtemp()
+    try:
+        cache = ObjectCache(scratch)
+        image, symbols = build(units, cache)
+        assert list(image) == expected
+        assert (cache.hits, cache.misses) == (0, 3)
+        assert symbols[1]["clear_screen"] == resolve_labels(sizing_events(list(parse(lines))), False)["clear_screen"]
+        assert "clear_screen" in cache.compile(units[2]).imports
+        assert not [name for name in os.listdir(scratch) if not name.endswith(".obj")]
+        # edit only the program: the runtime comes from disk
+        units[2] = units[2] + ["    SET A, 0x1234\n"]
+        image, symbols = build(units, cache)
+        assert (cache.hits, cache.misses) == (3, 4)
+        assert list(image) == list(assemble(lines + ["    SET A, 0x1234\n"], short_labels=False))
+        # the runtime can be placed anywhere
+        image, symbols = build([units[0], units[2], units[1]], cache)
+        dcpu = DCPU()
+        dcpu.load_program(image)
+        reference = DCPU()
+        reference.load_program(expected)
+        assert dcpu.run(100000)[0] == reference.run(100000)[0] == "halt"
+        assert dcpu.memory[0x8000:0x8400] == reference.memory[0x8000:0x8400]
+        for broken, message in [([["JSR nowhere"]], "Undefined symbol"),
+                                ([[":f SET A, 1"], [":f SET B, 1"], ["JSR f"]], "Ambiguous symbol")]:
+            try:
+                link([compile_object(unit) for unit in broken])
+                assert False, "linked"
+            except Exception as e:
+                assert str(e).startswith(message), e
+        print "--------"
+        print "LINKED", len(units), "units,", len(image), "words,", cache.hits, "cache hits"
+    finally:
+        shutil.rmtree(scratch)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2:
+        # linker.py [exe] [asm ...]: objects are cached in .dcpy-cache
+        sources = []
+        for name in sys.argv[2:]:
+            with open(name) as f:
+                sources.append(f.readlines())
+        image, symbols = build(sources, ObjectCache(".dcpy-cache"))
+        with open(sys.argv[1], 'wb') as g:
+            write_image(g, image)
+        sys.exit()
+    test_linker()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+from array import array
+from bisect import bisect_left, insort
+from common import *
+from decode import decode_table
+from disassembler import decompile_lines
+
+# A disassembled image indexed by address.  One linear pass over the image
+# records where each instruction starts and how long it is; text is only
+# formatted for the instructions that are asked for.  Literal JSR and
+# SET PC targets get synthesized labels.  Writing words re-decodes only as
+# far as the instruction boundaries need to move, and keeps the text search
+# index (once a search has built it) up to date as it goes.
+
+JSR = REVERSE_NONOPLOOKUP["JSR"]
+SET = REVERSE_OPLOOKUP["SET"]
+PC = 0x1c
+
+def label_name(addr, call):
+    return ("sub_%04x" if call else "loc_%04x") % addr
+
+class Listing(object):
+    def __init__(self, words):
+        self.words = array('H', words)
+        size = len(self.words)
+        # length of the instruction starting at each address, 0 elsewhere
+        self.lengths = bytearray(size)
+        # start of the instruction covering each address
+        self.starts = array('l', [0]) * size
+        # instruction start -> (target, whether it is a call)
+        self.branches = {}
+        # target -> set of instruction starts branching there
+        self.refs = {}
+        # instruction start -> text, filled in as instructions are asked for
+        self.texts = {}
+        # text -> sorted instruction starts, built by the first find
+        self._found = None
+        self._decode(0, size)
+
+    def __len__(self):
+        return len(self.words)
+
+    def _branch(self, start, length):
+        """ the literal target of a JSR or SET PC at start, if it has one """
+        words = self.words
+        table = decode_table()
+        word = words[start]
+        op, a, b = table.op[word], table.a[word], table.b[word]
+        if (op == 0 and a == JSR) or (op == SET and a == PC):
+            if b >= 0x20:
+                return (b - 0x20, op == 0)
+            if b == 0x1f and length == 2:
+                return (words[start + 1], op == 0)
+        return None
+
+    def _add(self, start, length):
+        self.lengths[start] = length
+        for i in xrange(start, start + length):
+            self.starts[i] = start
+        branch = self._branch(start, length)
+        if branch is not None:
+            self.branches[start] = branch
+            self.refs.setdefault(branch[0], set()).add(start)
+        if self._found is not None:
+            insort(self._found.setdefault(self.text(start), []), start)
+
+    def _remove(self, start):
+        self.lengths[start] = 0
+        text = self.texts.pop(start, None)
+        if self._found is not None:
+            # while the index exists every instruction's text is cached
+            found = self._found[text]
+            del found[bisect_left(found, start)]
+            if not found:
+                del self._found[text]
+        branch = self.branches.pop(start, None)
+        if branch is not None:
+            refs = self.refs[branch[0]]
+            refs.discard(start)
+            if not refs:
+                del self.refs[branch[0]]
+
+    def _decode(self, start, end):
+        """ decode instructions from start until past end and back in step
+            with the existing boundaries; returns where decoding stopped """
+        table = decode_table()
+        lengths, names = table.length, table.name
+        words = self.words
+        size = len(words)
+        addr = start
+        while addr < size:
+            if addr >= end and self.lengths[addr] and self.starts[addr] == addr:
+                break
+            word = words[addr]
+            # words that aren't instructions disassemble as one word of data
+            length = min(lengths[word] if names[word] else 1, size - addr)
+            for i in xrange(addr, addr + length):
+                if self.lengths[i]:
+                    self._remove(i)
+            self._add(addr, length)
+            addr += length
+        return addr
+
+    def instruction_at(self, addr):
+        """ (start, length) of the instruction covering addr """
+        start = self.starts[addr]
+        return start, self.lengths[start]
+
+    def text(self, addr):
+        """ the disassembly of the instruction covering addr """
+        start = self.starts[addr]
+        text = self.texts.get(start)
+        if text is None:
+            text = "\n".join(decompile_lines(self.words[start:start + self.lengths[start]]))
+            self.texts[start] = text
+        return text
+
+    def around(self, addr, before=5, after=5):
+        """ (start, text) for the instruction covering addr and up to before
+            and after instructions either side of it """
+        start = self.starts[addr]
+        first = start
+        for i in xrange(before):
+            if first == 0:
+                break
+            first = self.starts[first - 1]
+        lines = []
+        addr = first
+        while addr < len(self.words) and (addr <= start or after > 0):
+            if addr > start:
+                after -= 1
+            lines.append((addr, self.text(addr)))
+            addr += self.lengths[addr]
+        return lines
+
+    def label_at(self, addr):
+        """ the synthesized label for addr, if anything branches there """
+        refs = self.refs.get(addr)
+        if not refs:
+            return None
+        return label_name(addr, any(self.branches[start][1] for start in refs))
+
+    def lookup(self, label):
+        """ the address of a synthesized label """
+        try:
+            addr = int(label[4:], 16)
+        except ValueError:
+            raise KeyError(label)
+        if not 0 <= addr < len(self.words) or self.label_at(addr) != label:
+            raise KeyError(label)
+        return addr
+
+    def all_labels(self):
+        return dict((self.label_at(addr), addr) for addr in self.refs)
+
+    def find(self, text):
+        """ the start addresses of every instruction that disassembles to
+            text, in address order """
+        if self._found is None:
+            # built on the first search, then kept up to date by _add and
+            # _remove
+            found = {}
+            addr = 0
+            while addr < len(self.words):
+                found.setdefault(self.text(addr), []).append(addr)
+                addr += self.lengths[addr]
+            self._found = found
+        return self._found.get(text, [])
+
+    def update(self, addr, words):
+        """ overwrite the image from addr with words and re-decode what they
+            affect; returns the (start, end) range that was re-decoded """
+        end = addr + len(words)
+        assert 0 <= addr and end <= len(self.words)
+        self.words[addr:end] = array('H', words)
+        start = self.starts[addr]
+        return start, self._decode(start, end)
+
+def _check(listing):
+    """ the index must match a fresh linear disassembly """
+    addr = 0
+    lines = list(decompile_lines(listing.words, addresses=True))
+    for line in lines:
+        start = int(line[:6], 16)
+        assert start == addr, (start, addr)
+        assert listing.text(start) == line[8:]
+        addr += listing.lengths[start]
+    fresh = Listing(listing.words)
+    assert fresh.lengths == listing.lengths and fresh.starts == listing.starts
+    assert fresh.branches == listing.branches and fresh.refs == listing.refs
+    if listing._found is not None:
+        fresh.find("")
+        assert fresh._found == listing._found
+
+def test_listing():
+    """ lookups, labels and incremental updates must agree with
+        disassembling the whole image again """
+    import random
+    from image import read_image
+    rng = random.Random(16)
+    with open("dcpu16os.dexe", 'rb') as f:
+        os_words = read_image(f)
+    listing = Listing(os_words)
+    _check(listing)
+    for addr in xrange(len(listing)):
+        start, length = listing.instruction_at(addr)
+        assert start <= addr < start + length
+    labels = listing.all_labels()
+    assert listing.lookup(label_name(0x6d, False)) == 0x6d == os_words[1]
+    assert all(listing.lookup(name) == addr for name, addr in labels.iteritems())
+    for name in ["sub_zzzz", "bogus", "loc_0001", "loc_ffffff"]:
+        try:
+            listing.lookup(name)
+            assert False, name
+        except KeyError:
+            pass
+    assert listing.find("SET PC, POP") == [start for start in sorted(set(listing.starts))
+                                           if listing.text(start) == "SET PC, POP"]
+    print "--------"
+    print "\n".join("0x%04x %-10s %s" % (addr, listing.label_at(addr) or "", text)
+                    for addr, text in listing.around(0x13, 3, 3))
+    words = [rng.randint(0, 0xffff) for i in xrange(3000)]
+    listing = Listing(words)
+    _check(listing)
+    listing.find("SET A, 0x1")
+    found = listing._found
+    for i in xrange(200):
+        addr = rng.randint(0, len(words) - 4)
+        patch = [rng.choice([0x7c10, 0x7dc1, 0x7c01, 0x0001, 0x8401, rng.randint(0, 0xffff)])
+                 for j in xrange(rng.randint(1, 3))]
+        start, end = listing.update(addr, patch)
+        assert start <= addr and end >= addr + len(patch)
+        if i % 50 == 0:
+            _check(listing)
+    # updated in place, never rebuilt
+    assert listing._found is found
+    _check(listing)
+    assert listing.find("SET A, 0x1") == Listing(listing.words).find("SET A, 0x1")
+
+if __name__ == "__main__":
+    test_listing()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import random
+import numpy
+from array import array
+from common import *
+from emu import *
+
+# A data-parallel emulator: N machines ("lanes") keep their registers and
+# memory in (N, 11) and (N, 0x10000) uint16 arrays, and every instruction is
+# applied to all the lanes executing it in one vectorized operation.  Lanes
+# that have diverged are grouped by the instruction word at their PC, so
+# machines running the same code in lockstep cost one group per step.
+
+# Per-lane run states
+LANE_RUNNING = 0
+LANE_HALTED = 1
+LANE_BREAKPOINT = 2
+LANE_FAULTED = 3
+
+WORDS = numpy.array(OPERAND_WORDS, dtype=numpy.int64)
+
+class LockstepDCPU(object):
+    def __init__(self, n):
+        self.n = n
+        self.regs = numpy.zeros((n, len(REGISTER_NAMES)), dtype=numpy.uint16)
+        self.regs[:, REG_SP] = 0xffff
+        self.memory = numpy.zeros((n, 0x10000), dtype=numpy.uint16)
+        self.skip_next = numpy.zeros(n, dtype=bool)
+        self.last_pc = numpy.empty(n, dtype=numpy.int64)
+        self.last_pc.fill(-1)
+        self.cycles = numpy.zeros(n, dtype=numpy.int64)
+        # non-basic opcode each faulted lane stopped on
+        self.fault_op = numpy.zeros(n, dtype=numpy.int64)
+
+    @classmethod
+    def from_machines(cls, machines):
+        """ one lane per DCPU, each starting from that machine's state """
+        lanes = cls(len(machines))
+        for i, dcpu in enumerate(machines):
+            lanes.regs[i] = dcpu.regs
+            lanes.memory[i] = numpy.frombuffer(dcpu.memory.tostring(), dtype=numpy.uint16)
+            lanes.skip_next[i] = dcpu.skip_next
+            lanes.last_pc[i] = dcpu.last_pc
+            lanes.cycles[i] = dcpu.cycles
+        return lanes
+
+    def load_program(self, prog):
+        """ copy the same words into every lane starting at address 0 """
+        words = numpy.array(prog, dtype=numpy.uint16)
+        self.memory[:, :len(words)] = words
+
+    def lane(self, i):
+        """ a standalone DCPU in lane i's state """
+        dcpu = DCPU()
+        dcpu.load_program(array('H', self.memory[i].tostring()))
+        dcpu.regs[:] = [int(x) for x in self.regs[i]]
+        dcpu.skip_next = bool(self.skip_next[i])
+        dcpu.last_pc = int(self.last_pc[i])
+        dcpu.cycles = int(self.cycles[i])
+        return dcpu
+
+    def _location(self, lanes, code, word):
+        """ vectorized operand resolution, as emu.OPERANDS: returns
+            ("reg", index), ("mem", addresses) or ("lit", values) """
+        regs = self.regs
+        if code < 0x08:
+            return ("reg", code)
+        elif code < 0x10:
+            return ("mem", regs[lanes, code - 0x08].astype(numpy.int64))
+        elif code < 0x18:
+            return ("mem", (regs[lanes, code - 0x10].astype(numpy.int64) + word) & 0xffff)
+        elif code == 0x18:
+            sp = (regs[lanes, REG_SP].astype(numpy.int64) + 1) & 0xffff
+            regs[lanes, REG_SP] = sp
+            return ("mem", sp)
+        elif code == 0x19:
+            return ("mem", (regs[lanes, REG_SP].astype(numpy.int64) + 1) & 0xffff)
+        elif code == 0x1a:
+            sp = regs[lanes, REG_SP].astype(numpy.int64)
+            regs[lanes, REG_SP] = (sp - 1) & 0xffff
+            return ("mem", sp)
+        elif code == 0x1b:
+            return ("reg", REG_SP)
+        elif code == 0x1c:
+            return ("reg", REG_PC)
+        elif code == 0x1d:
+            return ("reg", REG_O)
+        elif code == 0x1e:
+            return ("mem", word)
+        elif code == 0x1f:
+            return ("lit", word)
+        else:
+            return ("lit", numpy.repeat(numpy.int64(code - 0x20), len(lanes)))
+
+    def _read(self, lanes, location):
+        kind, ref = location
+        if kind == "reg":
+            return self.regs[lanes, ref].astype(numpy.int64)
+        elif kind == "mem":
+            return self.memory[lanes, ref].astype(numpy.int64)
+        return ref
+
+    def _store(self, lanes, location, value):
+        kind, ref = location
+        if kind == "reg":
+            self.regs[lanes, ref] = value
+        elif kind == "mem":
+            self.memory[lanes, ref] = value
+
+    def _basic(self, lanes, op, a, av, bv):
+        """ apply basic opcode op to every lane, as emu.BASIC_OPS """
+        regs = self.regs
+        if op == 0x1:
+            self._store(lanes, a, bv)
+        elif op == 0x2:
+            x = av + bv
+            regs[lanes, REG_O] = x >> 16
+            self._store(lanes, a, x & 0xffff)
+        elif op == 0x3:
+            x = av - bv
+            regs[lanes, REG_O] = numpy.where(x < 0, 0xffff, 0)
+            self._store(lanes, a, x & 0xffff)
+        elif op == 0x4:
+            x = av * bv
+            regs[lanes, REG_O] = (x >> 16) & 0xffff
+            self._store(lanes, a, x & 0xffff)
+        elif op == 0x5 or op == 0x6:
+            nonzero = bv != 0
+            divisor = numpy.where(nonzero, bv, 1)
+            if op == 0x5:
+                regs[lanes, REG_O] = numpy.where(nonzero, ((av << 16) // divisor) & 0xffff, 0)
+                self._store(lanes, a, numpy.where(nonzero, av // divisor, 0))
+            else:
+                self._store(lanes, a, numpy.where(nonzero, av % divisor, 0))
+        elif op == 0x7:
+            # shifting a 16 bit value 32 or more places leaves nothing in
+            # either a or O, so clamp to keep the shift inside 64 bits
+            x = av << numpy.minimum(bv, 32)
+            regs[lanes, REG_O] = (x >> 16) & 0xffff
+            self._store(lanes, a, x & 0xffff)
+        elif op == 0x8:
+            shift = numpy.minimum(bv, 48)
+            regs[lanes, REG_O] = ((av << 16) >> shift) & 0xffff
+            self._store(lanes, a, av >> shift)
+        elif op == 0x9:
+            self._store(lanes, a, av & bv)
+        elif op == 0xa:
+            self._store(lanes, a, av | bv)
+        elif op == 0xb:
+            self._store(lanes, a, av ^ bv)
+        else:
+            if op == 0xc:
+                fail = av != bv
+            elif op == 0xd:
+                fail = av == bv
+            elif op == 0xe:
+                fail = av <= bv
+            else:
+                fail = (av & bv) == 0
+            self.skip_next[lanes] = fail
+            self.cycles[lanes] += fail
+
+    def _execute(self, lanes, word):
+        """ run the instruction whose first word is word on every lane in
+            lanes, each at its own PC """
+        op = word & 0xf
+        a = (word >> 4) & 0x3f
+        b = word >> 10
+        a_extra = int(WORDS[a]) if op else 0
+        b_extra = int(WORDS[b])
+        pc = self.regs[lanes, REG_PC].astype(numpy.int64)
+        a_word = self.memory[lanes, (pc + 1) & 0xffff].astype(numpy.int64) if a_extra else None
+        b_word = self.memory[lanes, (pc + 1 + a_extra) & 0xffff].astype(numpy.int64) if b_extra else None
+        length = 1 + a_extra + b_extra
+        self.regs[lanes, REG_PC] = (pc + length) & 0xffff
+
+        skipped = self.skip_next[lanes]
+        if skipped.any():
+            self.skip_next[lanes[skipped]] = False
+            keep = ~skipped
+            lanes = lanes[keep]
+            if a_word is not None: a_word = a_word[keep]
+            if b_word is not None: b_word = b_word[keep]
+            if not len(lanes):
+                return
+
+        self.cycles[lanes] += (BASIC_CYCLES[op] if op else NONBASIC_CYCLES[a]) + length - 1
+        if op:
+            a_loc = self._location(lanes, a, a_word)
+            b_loc = self._location(lanes, b, b_word)
+            bv = self._read(lanes, b_loc)
+            av = self._read(lanes, a_loc)
+            self._basic(lanes, op, a_loc, av, bv)
+        elif a == REVERSE_NONOPLOOKUP["JSR"]:
+            target = self._read(lanes, self._location(lanes, b, b_word))
+            sp = self.regs[lanes, REG_SP].astype(numpy.int64)
+            self.memory[lanes, sp] = self.regs[lanes, REG_PC]
+            self.regs[lanes, REG_SP] = (sp - 1) & 0xffff
+            self.regs[lanes, REG_PC] = target
+        else:
+            self.fault_op[lanes] = a
+            return lanes
+        return None
+
+    def run(self, max_cycles, breakpoints=()):
+        """ DCPU.run on every lane at once.  Returns a list with each lane's
+            (reason, cycles, detail), exactly as DCPU.run would for it. """
+        start = self.cycles.copy()
+        limit = start + max_cycles
+        state = numpy.zeros(self.n, dtype=numpy.int8)
+        first = numpy.ones(self.n, dtype=bool)
+        stops = numpy.array(sorted(breakpoints), dtype=numpy.int64)
+        while True:
+            lanes = numpy.nonzero((state == LANE_RUNNING) & (self.cycles < limit))[0]
+            if not len(lanes):
+                break
+            pc = self.regs[lanes, REG_PC].astype(numpy.int64)
+            halted = pc == self.last_pc[lanes]
+            state[lanes[halted]] = LANE_HALTED
+            stopped = ~first[lanes] & numpy.in1d(pc, stops) & ~halted
+            state[lanes[stopped]] = LANE_BREAKPOINT
+            going = ~(halted | stopped)
+            lanes = lanes[going]
+            pc = pc[going]
+            self.last_pc[lanes] = pc
+            first[lanes] = False
+            words = self.memory[lanes, pc]
+            for word in numpy.unique(words):
+                faulted = self._execute(lanes[words == word], int(word))
+                if faulted is not None:
+                    state[faulted] = LANE_FAULTED
+        results = []
+        for i in xrange(self.n):
+            cycles = int(self.cycles[i] - start[i])
+            if state[i] == LANE_HALTED:
+                results.append((STOP_HALT, cycles, None))
+            elif state[i] == LANE_BREAKPOINT:
+                results.append((STOP_BREAKPOINT, cycles, int(self.regs[i, REG_PC])))
+            elif state[i] == LANE_FAULTED:
+                opcode = int(self.fault_op[i])
+                results.append((STOP_FAULT, cycles, "UNKNOWN OPERATION: "+NONOPLOOKUP.get(opcode, "0x%x" % opcode)))
+            else:
+                results.append((STOP_CYCLES, cycles, None))
+        return results
+
+def test_lockstep():
+    """ every lane must end exactly where a lone DCPU would, whatever
+        program and initial registers it was given """
+    rng = random.Random(16)
+    sources = [case[0] for case in emu_cases] + \
+              ["fib.dexe", "fibtail.dexe", "notch.dexe", "genmul.dexe", "dcpu16os.dexe"]
+    machines = []
+    for source in sources:
+        for variant in xrange(4):
+            dcpu = DCPU()
+            dcpu.load_program(load_case(source))
+            if variant:
+                for r in xrange(len(REGISTERS)):
+                    dcpu.regs[r] = rng.choice([0, 1, 0x1f, 0x20, 0x8000, 0xffff, rng.randint(0, 0xffff)])
+            machines.append(dcpu)
+    for max_cycles, breakpoints in [(1, ()), (37, ()), (100000, ()), (5000, (0x1e, 0x7))]:
+        lanes = LockstepDCPU.from_machines(machines)
+        actual = lanes.run(max_cycles, breakpoints)
+        print "--------"
+        print "CASE", len(machines), "lanes", max_cycles, breakpoints
+        for i, dcpu in enumerate(machines):
+            expected_dcpu = dcpu.fork()
+            expected = expected_dcpu.run(max_cycles, breakpoints)
+            lane = lanes.lane(i)
+            assert actual[i] == expected, (i, actual[i], expected)
+            assert lane.regs == expected_dcpu.regs, (i, lane.regs, expected_dcpu.regs)
+            assert lane.memory == expected_dcpu.memory
+            assert (lane.skip_next, lane.last_pc, lane.cycles) == \
+                   (expected_dcpu.skip_next, expected_dcpu.last_pc, expected_dcpu.cycles)
+        print "STOPS", sorted(set(result[0] for result in actual))
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2:
+        # lockstep.py [exe] [lanes]: run copies of one program side by side
+        lanes = LockstepDCPU(int(sys.argv[2]))
+        with open(sys.argv[1], 'rb') as f:
+            lanes.load_program(read_image(f))
+        print lanes.run(10000000)[0]
+        print lanes.lane(0)
+        sys.exit()
+    test_lockstep()
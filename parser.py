@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 
-from dcpy import *
-from itertools import imap
+import re
+from common import *
 
 parser_cases = [
     ["SET A, 0x30", [("op", "SET", 0), ("regname", "A", 0), ("literal", 48, 1), ("newline", "\n", 1)]],
     ["SUB X, [0x1000]", [("op", "SUB", 0), ("regname", "X", 0), ("address", 0x1000, 1), ("newline", "\n", 1)]],
     ["SET [0x2000+I], [A]", [("op", "SET", 0), ("lit+reg", (0x2000, "I"), 1), ("regval", "A", 1), ("newline", "\n", 1)]],
+    ["SET [0x2000 + I], [ A ]", [("op", "SET", 0), ("lit+reg", (0x2000, "I"), 1), ("regval", "A", 1), ("newline", "\n", 1)]],
+    ["SET\t[I+0x10],0x1 ; x", [("op", "SET", 0), ("lit+reg", (0x10, "I"), 1), ("literal", 1, 1),
+                               ("comment", "; x", 1), ("newline", "\n", 1)]],
     ["JSR 0x28", [("op", "JSR", 0), ("literal", 0x28, 1), ("newline", "\n", 1)]],
     ["JSR 0x04", [("op", "JSR", 0), ("literal", 0x04, 0), ("newline", "\n", 0)]],
     ["SET POP, POP", [("op", "SET", 0), ("popname", "POP", 0), ("popname", "POP", 0), ("newline", "\n", 0)]],
@@ -29,72 +32,86 @@ def to_int(token):
     else:
         return int(token)
 
-def parse(source):
+def parse(source, tracer=None):
+    """ parse lines of assembly into a stream of (type, value, offset) IR,
+        reporting each item to tracer if one is given """
+    ir = parse_lines(source)
+    return ir if tracer is None else tracer.wrap("parse", ir)
+
+# Keyword tokens to their IR (type, value); anything else is a label, a
+# bracketed operand or a number
+KEYWORDS = dict([(op, ("op", op)) for op in REVERSE_OPLOOKUP] +
+                [(op, ("op", op)) for op in REVERSE_NONOPLOOKUP] +
+                [(reg, ("regname", reg)) for reg in REVERSE_REGLOOKUP] +
+                [("POP", ("popname", "POP")), ("PEEK", ("peekname", "PEEK")),
+                 ("PUSH", ("pushname", "PUSH")), ("SP", ("spname", "SP")),
+                 ("PC", ("pcname", "PC")), ("O", ("oname", "O"))])
+
+# One scan of a line splits it into a comment or DAT list (either runs to
+# the end of the line), bracketed operands (spaces and all) and words;
+# whitespace and commas between them are skipped.
+TOKEN = re.compile(r"(;.*)|DAT(?![^\s,;])(.*)|(\[[^\]]*\])|([^\s,;]+)", re.S)
+
+def parse_bracket(token, offset):
+    """ the IR for a [...] operand and the offset after it """
+    token = token[1:-1].strip()
+    if "+" in token:
+        sub = [x.strip() for x in token.split('+')]
+        assert len(sub) == 2
+        regindex = 0
+        for x in sub:
+            if len(x) == 1 and x.isalpha():
+                break
+            regindex += 1
+        assert regindex < 2
+        offset += 1
+        return ("lit+reg", (to_int(sub[1-regindex]), sub[regindex]), offset), offset
+    elif token in REVERSE_REGLOOKUP:
+        return ("regval", token, offset), offset
+    else:
+        offset += 1
+        return ("address", to_int(token), offset), offset
+
+def parse_data(rest):
+    data = []
+    for subtoken in rest.split(','):
+        subtoken = subtoken.strip()
+        if subtoken[0] == subtoken[-1] == '"':
+            for x in subtoken[1:-1]: data.append(ord(x))
+        else:
+            data.append(to_int(subtoken))
+    return data
+
+def parse_lines(source):
     offset = 0
+    keywords = KEYWORDS
     for line in source:
         saw_op = False
-        for token in line.strip().split(" "):
-            if len(token) == 0:
-                continue
-            if token[-1] == ',': token = token[:-1]
-            print "TOKEN", token
-            if token[0] == ':':
-                yield ("label", token[1:], offset)
-            elif token[0] == ';':
-                yield ("comment", line[line.index(';'):], offset)
-                break
-            elif token in REVERSE_OPLOOKUP.keys() or token in REVERSE_NONOPLOOKUP.keys():
-                saw_op = True
-                yield ("op", token, offset)
-            elif token in REVERSE_REGLOOKUP.keys():
-                yield ("regname", token, offset)
-            elif token == "POP":
-                yield ("popname", "POP", offset)
-            elif token == "PEEK":
-                yield ("peekname", "PEEK", offset)
-            elif token == "PUSH":
-                yield ("pushname", "PUSH", offset)
-            elif token == "SP":
-                yield ("spname", "SP", offset)
-            elif token == "PC":
-                yield ("pcname", "PC", offset)
-            elif token == "O":
-                yield ("oname", "O", offset)
-            elif token.startswith("[") and token.endswith("]"):
-                token = token[1:-1]
-                if "+" in token:
-                    sub = [x.strip() for x in token.split('+')]
-                    assert len(sub) == 2
-                    regindex = 0
-                    for x in sub:
-                        if len(x) == 1 and x.isalpha():
-                            break
-                        regindex += 1
-                    assert regindex < 2
-                    offset += 1
-                    yield ("lit+reg", (to_int(sub[1-regindex]), sub[regindex]), offset)
-                elif token in REVERSE_REGLOOKUP.keys():
-                    yield ("regval", token, offset)
+        for comment, data, bracket, token in TOKEN.findall(line):
+            if token:
+                kind = keywords.get(token)
+                if kind is not None:
+                    if kind[0] == "op":
+                        saw_op = True
+                    yield (kind[0], kind[1], offset)
+                elif token[0] == ':':
+                    yield ("label", token[1:], offset)
+                elif token[0].isalpha():
+                    yield ("label", token, offset)
                 else:
-                    offset += 1
-                    yield ("address", to_int(token), offset)
-            elif token == "DAT":
-                data = []
-                for subtoken in imap(lambda x: x.strip(), line[line.index("DAT ")+4:].split(',')):
-                    if subtoken[0] == subtoken[-1] == '"':
-                        for x in subtoken[1:-1]: data.append(ord(x))
-                    else:
-                        data.append(to_int(subtoken))
+                    val = to_int(token)
+                    if val > 0x1f:
+                        offset += 1
+                    yield ("literal", val, offset)
+            elif bracket:
+                item, offset = parse_bracket(bracket, offset)
+                yield item
+            elif comment:
+                yield ("comment", comment, offset)
+            else:
+                data = parse_data(data)
                 offset += len(data)
                 yield ("data", data, offset)
-                break
-            elif token[0].isalpha():
-                yield ("label", token, offset)
-            else:
-                val = to_int(token)
-                if val > 0x1f:
-                    offset += 1
-                yield ("literal", val, offset)
         yield ("newline", "\n", offset)
         if saw_op: offset += 1
 
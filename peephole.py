@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+from common import *
+from parser import parse
+from assembler import SHORT_LITERAL_MAX, calculate_label_offsets, compile_ir
+from decode import BASIC_CYCLES, NONBASIC_CYCLES
+
+# A peephole optimizer over the parser's IR, for running between parse and
+# compile_ir.  The IR is split into lines of (labels, instruction, comments)
+# and a library of rules rewrites short windows of consecutive instructions
+# until none applies.  A window never spans a label something refers to,
+# data, or an IF* and the instruction it guards, so control can't land in
+# the middle of a rewrite.  Labels are placed again by compile_ir, so
+# removing words is safe for programs that refer to code by label; code
+# reached through numeric addresses would move under them.
+
+CONDITIONALS = set(["IFE", "IFN", "IFG", "IFB"])
+
+# operands whose evaluation moves the stack pointer or depends on it
+STACK_OPERANDS = set(["popname", "peekname", "pushname", "spname"])
+
+# how far liveness looks ahead before assuming a register is live
+LIVENESS_LIMIT = 64
+
+def split_lines(ir):
+    """ [labels, instruction, comments, newline] for each line of IR, where
+        labels are the label items the line defines, instruction the op and
+        its operand items (or a data item), and comments the comment items """
+    lines = []
+    labels, inst, comments = [], [], []
+    for item in ir:
+        kind = item[0]
+        if kind == "newline":
+            lines.append([labels, tuple(inst), comments, item])
+            labels, inst, comments = [], [], []
+        elif kind == "comment":
+            comments.append(item)
+        elif kind == "label" and not inst:
+            labels.append(item)
+        else:
+            inst.append(item)
+    if labels or inst or comments:
+        lines.append([labels, tuple(inst), comments, ("newline", "\n", 0)])
+    return lines
+
+def join_lines(lines):
+    ir = []
+    for labels, inst, comments, newline in lines:
+        ir.extend(labels)
+        ir.extend(inst)
+        ir.extend(comments)
+        ir.append(newline)
+    return ir
+
+def _key(inst):
+    """ an instruction without its offsets """
+    return tuple(item[:2] for item in inst)
+
+def registers(inst):
+    """ (read, written): the general registers an instruction reads and the
+        ones it writes """
+    op = inst[0][1]
+    reads, writes = set(), set()
+    for position, item in enumerate(inst[1:]):
+        kind = item[0]
+        if kind == "regname":
+            if position == 0 and op != "JSR" and op not in CONDITIONALS:
+                writes.add(item[1])
+                if op != "SET":
+                    reads.add(item[1])
+            else:
+                reads.add(item[1])
+        elif kind == "regval":
+            reads.add(item[1])
+        elif kind == "lit+reg":
+            reads.add(item[1][1])
+    return reads, writes
+
+def instruction_cost(inst, offsets, short_labels=True):
+    """ (words, cycles) for an instruction, with label operands sized as
+        compile_ir would given offsets; a failed IF* costs one more """
+    if inst[0][0] == "data":
+        return len(inst[0][1]), 0
+    words = 1
+    for kind, value, offset in inst[1:]:
+        if kind == "lit+reg" or kind == "address":
+            words += 1
+        elif kind == "literal" and value > SHORT_LITERAL_MAX:
+            words += 1
+        elif kind == "label" and not (short_labels and offsets[value] <= SHORT_LITERAL_MAX):
+            words += 1
+    op = inst[0][1]
+    if op in REVERSE_OPLOOKUP:
+        cycles = BASIC_CYCLES[REVERSE_OPLOOKUP[op]]
+    else:
+        cycles = NONBASIC_CYCLES[REVERSE_NONOPLOOKUP[op]]
+    return words, cycles + words - 1
+
+def program_cost(lines, short_labels=True):
+    """ total (words, cycles) of every instruction in lines """
+    offsets = calculate_label_offsets(join_lines(lines), short_labels)
+    words = cycles = 0
+    for labels, inst, comments, newline in lines:
+        if inst:
+            w, c = instruction_cost(inst, offsets, short_labels)
+            words += w
+            cycles += c
+    return words, cycles
+
+class Program(object):
+    """ lines being rewritten, with where each label is defined and the
+        labels that anything refers to """
+    def __init__(self, lines):
+        self.lines = lines
+        self.definitions = {}
+        self.referenced = set()
+        for index, (labels, inst, comments, newline) in enumerate(lines):
+            for item in labels:
+                self.definitions[item[1]] = index
+            for item in inst[1:]:
+                if item[0] == "label":
+                    self.referenced.add(item[1])
+
+    def entered(self, index):
+        """ whether control can arrive at line index other than by falling
+            through from the line before """
+        return any(item[1] in self.referenced for item in self.lines[index][0])
+
+    def next_instruction(self, index):
+        """ the first line at or after index with an instruction, or None """
+        while index < len(self.lines):
+            if self.lines[index][1]:
+                return index
+            index += 1
+        return None
+
+    def dead(self, register, index, limit=LIVENESS_LIMIT):
+        """ whether every path from line index writes register before
+            reading it.  Jumps and calls to labels are followed; anything
+            else that moves PC, data, running out of program or of limit
+            count as reading it. """
+        seen = set()
+        conditional = False
+        while limit > 0:
+            index = self.next_instruction(index)
+            if index is None or index in seen:
+                return False
+            seen.add(index)
+            inst = self.lines[index][1]
+            if inst[0][0] == "data":
+                return False
+            limit -= 1
+            op = inst[0][1]
+            reads, writes = registers(inst)
+            if register in reads:
+                return False
+            if op == "JSR" or inst[1][0] == "pcname" and op not in CONDITIONALS:
+                target = inst[-1]
+                if conditional or target[0] != "label" or target[1] not in self.definitions:
+                    return False
+                if op == "JSR":
+                    # whatever happens after the call, the callee decides
+                    return self.dead(register, self.definitions[target[1]], limit)
+                if op != "SET":
+                    return False
+                index = self.definitions[target[1]]
+                continue
+            if register in writes and not conditional:
+                return True
+            conditional = op in CONDITIONALS
+            index += 1
+        return False
+
+# Rules take the program, the window's instructions and the index of the
+# line after the window, and return the instructions to put in its place,
+# or None.
+
+def _set(inst, dest=None, source=None):
+    """ whether inst is SET with destination and source of those kinds """
+    return inst[0][:2] == ("op", "SET") and \
+        (dest is None or inst[1][0] in dest) and (source is None or inst[2][0] in source)
+
+def push_pop(program, window, after):
+    """ SET PUSH, v / SET r, POP -> SET r, v (the word below the stack
+        pointer is no longer written) """
+    first, second = window
+    if _set(first, ["pushname"]) and _set(second, None, ["popname"]) and \
+       first[2][0] not in STACK_OPERANDS and first[2][0] != "pcname" and \
+       second[1][0] not in STACK_OPERANDS:
+        return [(second[0], second[1], first[2])]
+
+def pop_push(program, window, after):
+    """ SET r, POP / SET PUSH, r -> SET r, PEEK """
+    first, second = window
+    if _set(first, ["regname"], ["popname"]) and _set(second, ["pushname"], ["regname"]) and \
+       first[1][1] == second[2][1]:
+        return [(first[0], first[1], ("peekname", "PEEK", first[2][2]))]
+
+def self_set(program, window, after):
+    """ SET a, a -> nothing, for operands without side effects """
+    inst, = window
+    if _set(inst, ["regname", "regval", "address", "lit+reg", "peekname", "spname", "oname"]) and \
+       _key(inst)[1] == _key(inst)[2]:
+        return []
+
+def identity(program, window, after):
+    """ BOR a, 0 / XOR a, 0 / AND a, 0xffff -> nothing (none of them set O) """
+    inst, = window
+    if len(inst) == 3 and inst[1][0] not in STACK_OPERANDS and inst[2][0] == "literal" and \
+       (inst[0][1], inst[2][1]) in [("BOR", 0), ("XOR", 0), ("AND", 0xffff)]:
+        return []
+
+def jump_next(program, window, after):
+    """ SET PC, label -> nothing, when label is the next instruction """
+    inst, = window
+    if _set(inst, ["pcname"], ["label"]):
+        target = program.definitions.get(inst[2][1])
+        if target is not None and after <= target and \
+           program.next_instruction(after) == program.next_instruction(target):
+            return []
+
+def dead_set(program, window, after):
+    """ SET r, v -> nothing, when every path writes r before reading it """
+    inst, = window
+    if _set(inst, ["regname"]) and inst[2][0] not in ("popname", "pushname") and \
+       program.dead(inst[1][1], after):
+        return []
+
+RULES = [
+    ("push_pop", 2, push_pop),
+    ("pop_push", 2, pop_push),
+    ("self_set", 1, self_set),
+    ("identity", 1, identity),
+    ("jump_next", 1, jump_next),
+    ("dead_set", 1, dead_set),
+]
+
+def _rewrite(program, size, rule):
+    """ one pass of rule over the program; returns the number of rewrites """
+    lines = program.lines
+    count = 0
+    previous = None
+    index = program.next_instruction(0)
+    while index is not None:
+        window = [index]
+        while len(window) < size:
+            following = program.next_instruction(window[-1] + 1)
+            if following is None or any(program.entered(i) for i in xrange(window[-1] + 1, following + 1)):
+                break
+            window.append(following)
+        insts = [lines[i][1] for i in window]
+        guarded = previous is not None and lines[previous][1][0][0] == "op" and \
+            lines[previous][1][0][1] in CONDITIONALS
+        replacement = None
+        if len(window) == size and all(inst[0][0] == "op" and inst[0][1] not in CONDITIONALS
+                                       for inst in insts):
+            replacement = rule(program, insts, window[-1] + 1)
+        # a guarded window may only trade one instruction for another
+        if replacement is not None and not (guarded and (size != 1 or len(replacement) != 1)):
+            for i, line in enumerate(window):
+                lines[line][1] = tuple(replacement[i]) if i < len(replacement) else ()
+            count += 1
+            previous = None
+            index = program.next_instruction(window[0])
+        else:
+            previous = index
+            index = program.next_instruction(index + 1)
+    return count
+
+def optimize(ir, short_labels=True):
+    """ (ir, report): the IR with every rule applied until none matches, and
+        {"words": words saved, "cycles": cycles saved if each instruction
+        ran once, "rules": rewrites made by each rule} """
+    lines = split_lines(ir)
+    words, cycles = program_cost(lines, short_labels)
+    program = Program(lines)
+    applied = dict((name, 0) for name, size, rule in RULES)
+    changed = True
+    while changed:
+        changed = False
+        for name, size, rule in RULES:
+            count = _rewrite(program, size, rule)
+            applied[name] += count
+            changed = changed or count > 0
+    after_words, after_cycles = program_cost(lines, short_labels)
+    report = {"words": words - after_words, "cycles": cycles - after_cycles, "rules": applied}
+    return join_lines(lines), report
+
+def format_report(report):
+    return "saved %d words, %d cycles (%s)" % (report["words"], report["cycles"], ", ".join(
+        "%s %d" % (name, report["rules"][name]) for name, size, rule in RULES if report["rules"][name]))
+
+peephole_cases = [
+    [["SET PUSH, X", "SET Y, POP"], ["SET Y, X"]],
+    [["SET PUSH, [0x10+A]", "SET PC, POP"], ["SET PC, [0x10+A]"]],
+    [["SET PUSH, X", "SET X, POP"], []],
+    [["SET PUSH, PEEK", "SET X, POP"], ["SET PUSH, PEEK", "SET X, POP"]],
+    [["SET Y, POP", "SET PUSH, Y", "ADD A, Y"], ["SET Y, PEEK", "ADD A, Y"]],
+    [["SET Y, POP", "SET PUSH, Y", "SET Y, 1"], ["SET Y, 1"]],
+    [["BOR A, 0", "XOR B, 0x0", "AND C, 0xffff", "ADD A, 0"], ["ADD A, 0"]],
+    [["SET PC, next", "; nothing", ":next SET A, 1"], ["; nothing", ":next SET A, 1"]],
+    [["IFE A, 1", "SET PC, next", ":next SET A, 1"], ["IFE A, 1", "SET PC, next", ":next SET A, 1"]],
+    [["IFE A, 1", "SET PUSH, X", "SET X, POP"], ["IFE A, 1", "SET PUSH, X", "SET X, POP"]],
+    [["SET PUSH, X", ":in SET Y, POP", "SET PC, in"], ["SET PUSH, X", ":in SET Y, POP", "SET PC, in"]],
+    [["SET PUSH, X", ":unused SET Y, POP"], ["SET Y, X", ":unused"]],
+    [["SET A, B", "JSR f", "SET PC, POP", ":f SET A, 2", "SET PC, POP"],
+     ["JSR f", "SET PC, POP", ":f SET A, 2", "SET PC, POP"]],
+    [["SET A, B", "IFE C, 1", "SET A, 2", "SET PC, POP"], ["SET A, B", "IFE C, 1", "SET A, 2", "SET PC, POP"]],
+    [["SET A, B", "SET PC, POP"], ["SET A, B", "SET PC, POP"]],
+]
+
+def test_peephole():
+    """ each rule on its own, then on translated and sample programs: the
+        optimized program must end in the same state in fewer cycles """
+    from assembler import assemble
+    from emu import DCPU, REGISTER_NAMES
+    from trans import translate, translate_cases
+    for source, expected in peephole_cases:
+        ir, report = optimize(list(parse(source)))
+        print "--------"
+        print "SOURCE  ", source
+        print "EXPECTED", expected
+        print "REPORT  ", format_report(report)
+        assert [item[:2] for item in ir if item[0] != "newline"] == \
+               [item[:2] for item in parse(expected) if item[0] != "newline"]
+        assert report["words"] == len(list(compile_ir(list(parse(source))))) - \
+                                  len(list(compile_ir(list(parse(expected)))))
+    # translated code leaves its last return address, which moves, in Z
+    programs = [(dasm, "PC Z") for source, dasm in translate_cases]
+    programs.append((list(translate("(ADD (SUB 4 (MUL 2 3)) (XOR (SUB 7 (ADD 1 1)) 3))")), "PC Z"))
+    for name in ["fib.dasm", "fibtail.dasm", "genmul.dasm", "dcpu16os.dasm"]:
+        with open(name) as f:
+            programs.append((f.readlines(), "PC"))
+    saved = 0
+    for lines, moved in programs:
+        ir = list(parse(lines))
+        optimized, report = optimize(ir)
+        saved += report["words"]
+        machines = []
+        for program in [ir, optimized]:
+            dcpu = DCPU()
+            dcpu.load_program(list(compile_ir(program)))
+            assert dcpu.run(1000000)[0] == "halt"
+            machines.append(dcpu)
+        plain, better = machines
+        for reg in REGISTER_NAMES:
+            if reg not in moved.split():
+                assert plain.registers[reg] == better.registers[reg], (reg, lines)
+        assert plain.memory[0x8000:0x8400] == better.memory[0x8000:0x8400]
+        assert better.cycles <= plain.cycles
+        assert report["words"] == len(list(compile_ir(ir))) - len(list(compile_ir(optimized)))
+    print "--------"
+    print "PEEPHOLE saved", saved, "words over", len(programs), "programs"
+    ir, report = optimize(list(parse(translate_cases[3][1])))
+    assert report["words"] == report["cycles"] == 2 and report["rules"]["dead_set"] == 1
+    assert list(assemble(translate_cases[3][1], optimize=True)) == list(compile_ir(ir))
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # peephole.py [asm] [exe]
+        from image import write_image
+        with open(sys.argv[1]) as f:
+            ir, report = optimize(list(parse(f.readlines())))
+        print format_report(report)
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'wb') as g:
+                write_image(g, list(compile_ir(ir)))
+        sys.exit()
+    test_peephole()
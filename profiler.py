@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+from bisect import bisect_right
+from collections import Counter
+from common import *
+from parser import parse
+from assembler import assemble, calculate_label_offsets
+from tracing import Tracer
+from emu import DCPU
+
+# An opt-in execution profiler.  It is a Tracer, so a machine only pays for
+# it while it is attached: with no tracer the emulator keeps its untraced
+# loop.  Cycles are charged to an address by reading the machine's cycle
+# counter between instructions, so failed IFs are charged their extra cycle.
+
+# operand codes to the parser's names for their addressing modes
+OPERAND_MODES = ["regname"] * 0x8 + ["regval"] * 0x8 + ["lit+reg"] * 0x8 + \
+                ["popname", "peekname", "pushname", "spname", "pcname", "oname",
+                 "address", "literal"] + ["literal"] * 0x20
+
+class Profiler(Tracer):
+    """ counts executions of each opcode, operand mode and address, and
+        the cycles spent at each address, for the machine it is attached to """
+    def __init__(self, dcpu):
+        self.dcpu = dcpu
+        dcpu.tracer = self
+        self.opcodes = Counter()
+        self.modes = Counter()
+        self.counts = Counter()
+        self.cycles = Counter()
+        self.skipped = Counter()
+        self.pending = None
+
+    def _settle(self):
+        """ charge the cycles spent since the last instruction started """
+        if self.pending is not None:
+            pc, start = self.pending
+            self.cycles[pc] += self.dcpu.cycles - start
+            self.pending = None
+
+    def instruction(self, pc, record, skipped):
+        self._settle()
+        if skipped:
+            self.skipped[pc] += 1
+            return
+        op, a, a_word, b = record[:4]
+        if op:
+            self.opcodes[OPLOOKUP[op]] += 1
+            self.modes[OPERAND_MODES[a]] += 1
+        else:
+            self.opcodes[NONOPLOOKUP.get(a, "0x%x" % a)] += 1
+        self.modes[OPERAND_MODES[b]] += 1
+        self.counts[pc] += 1
+        self.pending = (pc, self.dcpu.cycles)
+
+    def close(self):
+        self._settle()
+        self.dcpu.tracer = None
+
+def source_map(lines):
+    """ (labels, addresses): label name to address, as the assembler places
+        them, and instruction address to (line number, line) """
+    ir = []
+    line_start = 0
+    number = 0
+    for item in parse(lines):
+        if item[0] == "op":
+            # a label on a line of its own just before this one lands
+            # where the assembler puts this instruction, skew and all
+            ir[line_start:line_start] = [("label", ("line", number), item[2]), ("newline", "\n", item[2])]
+        ir.append(item)
+        if item[0] == "newline":
+            line_start = len(ir)
+            number += 1
+    labels = {}
+    addresses = {}
+    for name, addr in calculate_label_offsets(ir).iteritems():
+        if isinstance(name, tuple):
+            addresses[addr] = (name[1], lines[name[1]].rstrip("\n"))
+        else:
+            labels[name] = addr
+    return labels, addresses
+
+def locate(addr, labels):
+    """ addr as the nearest label at or before it plus an offset """
+    named = sorted((a, name) for name, a in labels.iteritems())
+    i = bisect_right(named, (addr, "\xff"))
+    if not i:
+        return "0x%04x" % addr
+    a, name = named[i - 1]
+    return name if a == addr else "%s+%d" % (name, addr - a)
+
+def hotspot_report(profiler, lines=None, top=20):
+    """ the top addresses by cycles spent, each with its label and source
+        line when the program's source lines are given, then the opcode
+        and operand mode totals """
+    labels, addresses = source_map(lines) if lines is not None else ({}, {})
+    total = sum(profiler.cycles.itervalues()) or 1
+    out = ["%-6s %-24s %9s %9s %6s  %s" % ("addr", "label", "count", "cycles", "%", "source")]
+    for pc, cycles in sorted(profiler.cycles.iteritems(), key=lambda pair: (-pair[1], pair[0]))[:top]:
+        number, line = addresses.get(pc, (None, ""))
+        source = "%d: %s" % (number + 1, line.strip()) if number is not None else ""
+        out.append("0x%04x %-24s %9d %9d %6.2f  %s" % (
+            pc, locate(pc, labels), profiler.counts[pc], cycles, 100.0 * cycles / total, source))
+    out.append("")
+    out.append("opcodes: " + ", ".join("%s %d" % pair for pair in profiler.opcodes.most_common()))
+    out.append("modes:   " + ", ".join("%s %d" % pair for pair in profiler.modes.most_common()))
+    return "\n".join(out)
+
+def profile(lines, max_cycles=1000000):
+    """ assemble lines, run them under a profiler and return it """
+    dcpu = DCPU()
+    dcpu.load_program(list(assemble(lines)))
+    profiler = Profiler(dcpu)
+    dcpu.run(max_cycles)
+    profiler.close()
+    return profiler
+
+def test_profiler():
+    """ the profile must account for every cycle, and map each address back
+        to the source line that assembled to it """
+    for name in ["fib.dasm", "fibtail.dasm", "genmul.dasm", "notch.dasm", "dcpu16os.dasm"]:
+        with open(name) as f:
+            lines = f.readlines()
+        prog = list(assemble(lines))
+        plain = DCPU()
+        plain.load_program(prog)
+        expected = plain.run(100000)
+        profiler = profile(lines, 100000)
+        assert sum(profiler.cycles.itervalues()) == expected[1] == profiler.dcpu.cycles
+        assert sum(profiler.opcodes.itervalues()) == sum(profiler.counts.itervalues())
+        assert profiler.dcpu.regs == plain.regs and profiler.dcpu.tracer is None
+        labels, addresses = source_map(lines)
+        assert labels == calculate_label_offsets(list(parse(lines)))
+        for addr, (number, line) in addresses.iteritems():
+            word = prog[addr]
+            op = OPLOOKUP[word & 0xf] if word & 0xf else NONOPLOOKUP[(word >> 4) & 0x3f]
+            words = [token for token in line.split(";")[0].split() if not token.startswith(":")]
+            assert words[0] == op, (name, addr, line)
+        print "--------"
+        print name, expected
+        print hotspot_report(profiler, lines, 5)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # profiler.py [asm] [max_cycles]
+        with open(sys.argv[1]) as f:
+            lines = f.readlines()
+        max_cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        print hotspot_report(profile(lines, max_cycles), lines)
+        sys.exit()
+    test_profiler()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import struct
+from collections import deque
+from common import *
+from disassembler import decompile_instructions
+
+# Pluggable tracing for the toolchain.  Nothing here is consulted unless a
+# tracer is handed in: the emulator only switches to its traced loop when
+# DCPU.tracer is set, and parse/compile_ir/astify/translate only wrap their
+# streams when given a tracer argument.
+
+# pc, first word, a's next word, b's next word, flags
+BINARY_RECORD = struct.Struct('>HHHHB')
+BINARY_SKIPPED = 0x1
+
+def instruction_words(record):
+    """ the words a decoded (op, a, a_word, b, b_word, length, cycles)
+        record came from """
+    op, a, a_word, b, b_word = record[:5]
+    words = [op | (a << 4) | (b << 10)]
+    if a_word is not None:
+        words.append(a_word)
+    if b_word is not None:
+        words.append(b_word)
+    return words
+
+def format_instruction(pc, record, skipped):
+    """ one line of human-readable trace for an executed instruction """
+    s = "0x%04x\t%s" % (pc, decompile_instructions(instruction_words(record)).strip())
+    if skipped:
+        s += "\t; skipped"
+    return s
+
+class Tracer(object):
+    """ a trace sink that ignores everything; subclasses override the
+        events they care about """
+    def instruction(self, pc, record, skipped):
+        """ the emulator is about to execute (or skip) record at pc """
+        pass
+
+    def event(self, stage, item):
+        """ a toolchain stage (parse, compile_ir, astify, translate)
+            produced or consumed item """
+        pass
+
+    def wrap(self, stage, items):
+        """ pass a stream through, reporting each item as an event """
+        for item in items:
+            self.event(stage, item)
+            yield item
+
+    def close(self):
+        pass
+
+class RingTracer(Tracer):
+    """ keeps the last size executed instructions as (pc, record, skipped) """
+    def __init__(self, size):
+        self.ring = deque(maxlen=size)
+
+    def instruction(self, pc, record, skipped):
+        self.ring.append((pc, record, skipped))
+
+    def __iter__(self):
+        return iter(self.ring)
+
+    def __len__(self):
+        return len(self.ring)
+
+    def lines(self):
+        return [format_instruction(*entry) for entry in self.ring]
+
+class BinaryTracer(Tracer):
+    """ writes each executed instruction to f as a fixed-size big-endian
+        record; read them back with read_binary_trace """
+    def __init__(self, f):
+        self.f = f
+
+    def instruction(self, pc, record, skipped):
+        words = instruction_words(record)
+        a_word = record[2] if record[2] is not None else 0
+        b_word = record[4] if record[4] is not None else 0
+        flags = BINARY_SKIPPED if skipped else 0
+        self.f.write(BINARY_RECORD.pack(pc, words[0], a_word, b_word, flags))
+
+    def close(self):
+        self.f.flush()
+
+def read_binary_trace(f):
+    """ yields (pc, first word, a's next word, b's next word, skipped) """
+    size = BINARY_RECORD.size
+    chunk = f.read(size)
+    while len(chunk) == size:
+        pc, word, a_word, b_word, flags = BINARY_RECORD.unpack(chunk)
+        yield (pc, word, a_word, b_word, bool(flags & BINARY_SKIPPED))
+        chunk = f.read(size)
+
+class TextTracer(Tracer):
+    """ writes every instruction and event to f as readable lines """
+    def __init__(self, f):
+        self.f = f
+
+    def instruction(self, pc, record, skipped):
+        self.f.write(format_instruction(pc, record, skipped)+"\n")
+
+    def event(self, stage, item):
+        self.f.write("%s\t%s\n" % (stage, str(item)))
+
+    def close(self):
+        self.f.flush()
+
+def test_tracing():
+    """ each sink sees the same instructions the emulator executed """
+    from StringIO import StringIO
+    from emu import DCPU, REG_PC, load_case
+    prog = load_case("fibtail.dexe")
+    pcs = []
+    dcpu = DCPU()
+    dcpu.load_program(prog)
+    while True:
+        pc = dcpu.regs[REG_PC]
+        if not dcpu.step(): break
+        pcs.append(pc)
+    ring = RingTracer(8)
+    binary = StringIO()
+    text = StringIO()
+    for tracer in (ring, BinaryTracer(binary), TextTracer(text)):
+        dcpu = DCPU()
+        dcpu.load_program(prog)
+        dcpu.tracer = tracer
+        dcpu.run(1000000)
+        tracer.close()
+    print "--------"
+    print "\n".join(ring.lines())
+    assert [entry[0] for entry in ring] == pcs[-8:]
+    binary.seek(0)
+    assert [entry[0] for entry in read_binary_trace(binary)] == pcs
+    lines = text.getvalue().split("\n")[:-1]
+    assert [int(line.split("\t")[0], 16) for line in lines] == pcs
+    assert lines[-1] == "0x%04x\tSET PC, 0x17" % pcs[-1]
+
+if __name__ == "__main__":
+    test_tracing()
@@ -94,33 +94,143 @@ SET X, POP
 """.split("\n"))
 ]
 
+# Expected output with constant folding on
+fold_cases = [
+("(MUL (ADD 1 2) (SUB 5 3))",
+"""\
+:start0 SET X, 6
+:return0 SET PC, :return0\
+""".split("\n"))
+
+,("(SUB (ADD 0xfff0 0x20) (SUB 1 2))",
+"""\
+:start0 SET X, 17
+:return0 SET PC, :return0\
+""".split("\n"))
+
+,("(MUL (ADD 1 2) A)",
+"""\
+SET PC, :start0
+:start_MUL SET Z, POP
+SET X, POP
+SET Y, POP
+MUL X, Y
+SET PUSH, X
+:return_MUL SET PC, Z
+:start0 SET PUSH, A
+SET PUSH, 3
+JSR :start_MUL
+SET X, POP
+:return0 SET PC, :return0\
+""".split("\n"))
+]
+
+# Expected output with inline code generation on
+inline_cases = [
+("(MUL (ADD 1 2) (SUB 5 3))",
+"""\
+:start0 SET X, 1
+ADD X, 2
+SET Y, 5
+SUB Y, 3
+MUL X, Y
+:return0 SET PC, :return0\
+""".split("\n"))
+
+,("(SUB 4 (ADD (SET 2 3) 1))",
+"""\
+SET PC, :start0
+:start_SET SET Z, POP
+SET X, POP
+SET Y, POP
+SET X, Y
+SET PUSH, X
+:return_SET SET PC, Z
+:start0 SET PUSH, 3
+SET PUSH, 2
+JSR :start_SET
+SET Y, POP
+ADD Y, 1
+SET X, 4
+SUB X, Y
+:return0 SET PC, :return0\
+""".split("\n"))
+]
+
+# Expected output with common subexpressions shared
+cse_cases = [
+("(ADD (MUL 3 4) (MUL 3 4))",
+"""\
+:start0 SET Z, 3
+MUL Z, 4
+SET X, Z
+ADD X, Z
+:return0 SET PC, :return0\
+""".split("\n"))
+
+,("(ADD (ADD (MUL A B) (MUL A B)) (ADD (ADD C I) (ADD J Y)))",
+"""\
+ADD PC, 1
+DAT 0
+:start0 SET X, A
+MUL X, B
+SET [0x1], X
+SET Z, C
+ADD Z, I
+SET X, J
+ADD X, Y
+ADD Z, X
+SET X, [0x1]
+ADD X, [0x1]
+ADD X, Z
+:return0 SET PC, :return0\
+""".split("\n"))
+]
+
+import re
+from itertools import chain
+from assembler import SHORT_LITERAL_MAX
+
 REG = "XYIJABCZ"
 
+# Operators translation can evaluate itself, giving what the DCPU-16 leaves
+# in the destination: 16 bit wraparound, and 0 for division by zero.  The
+# overflow register isn't modelled; generated code never reads it.
+FOLDS = {
+    "ADD": lambda a, b: (a + b) & 0xffff,
+    "SUB": lambda a, b: (a - b) & 0xffff,
+    "MUL": lambda a, b: (a * b) & 0xffff,
+    "DIV": lambda a, b: a / b if b else 0,
+    "MOD": lambda a, b: a % b if b else 0,
+    "SHL": lambda a, b: (a << b) & 0xffff,
+    "SHR": lambda a, b: a >> b,
+    "AND": lambda a, b: a & b,
+    "BOR": lambda a, b: a | b,
+    "XOR": lambda a, b: a ^ b,
+}
+
+# A comment runs to the end of its line; spaces, tabs and newlines separate
+# tokens, and parentheses are tokens of their own
+TOKEN = re.compile(r";[^\n]*|[()]|[^ \t\n();]+")
+
 def tokenize(stream):
-    in_comment = False
-    last = []
-    for c in stream:
-        if in_comment:
-            if c == "\n":
-                in_comment = False
-                if len(last) > 0:
-                    yield "".join(last)
-                    last = []
-        elif c == ";":
-            in_comment = True
-        elif c == " " or c == "\t" or c == "\n":
-            if len(last) > 0:
-                yield "".join(last)
-                last = []
-        elif c == "(" or c == ")":
-            if len(last) > 0: 
-                yield "".join(last)
-                last = []
-            yield c
-        else:
-            last.append(c)
-    if len(last) > 0:
-        yield "".join(last)
+    """ tokens from a string, or from an iterable of strings (lines, or
+        chunks read from a file) that may split a token between them """
+    if isinstance(stream, basestring):
+        stream = [stream]
+    carry = ""
+    for chunk in stream:
+        chunk = carry + chunk
+        carry = ""
+        for match in TOKEN.finditer(chunk):
+            token = match.group()
+            if match.end() == len(chunk) and token != "(" and token != ")":
+                # may go on in the next chunk
+                carry = token
+            elif token[0] != ";":
+                yield token
+    if carry and carry[0] != ";":
+        yield carry
 
 class Node(object):
     def __init__(self, inner=None, terminal=None):
@@ -136,49 +246,139 @@ class Node(object):
         start = '<Node>' 
         end = '</Node>'
         tabs = lambda t: "\t"*t
-        s =  tabs(depth)+start+"\n"
-        if self.inner is not None:
-            s += tabs(depth+1)+"INNER: "+self.inner+"\n"
-        if self.terminal is not None:
-            s += tabs(depth+1)+"TERMINAL: "+self.terminal+"\n"
-        child_strs = [child.nodestr(depth+1) for child in self.children]
-        for line in child_strs:
-            s += line+"\n"
-        s += tabs(depth)+end
-        return s
+        pieces = []
+        # nodes still to write, and the text that closes each one
+        stack = [(self, depth)]
+        while stack:
+            node, depth = stack.pop()
+            if not isinstance(node, Node):
+                pieces.append(node)
+                continue
+            pieces.append(tabs(depth)+start+"\n")
+            if node.inner is not None:
+                pieces.append(tabs(depth+1)+"INNER: "+node.inner+"\n")
+            if node.terminal is not None:
+                pieces.append(tabs(depth+1)+"TERMINAL: "+node.terminal+"\n")
+            stack.append((tabs(depth)+end, depth))
+            for child in reversed(node.children):
+                stack.append(("\n", depth))
+                stack.append((child, depth+1))
+        return "".join(pieces)
     def accept_postorder(self, visitor, depth=0):
-        if self.inner is not None:
-            for child in self.children:
-                for item in child.accept_postorder(visitor, depth+1):
+        """ yields what visitor.visit yields for each inner node, children
+            before parents, walking with a stack rather than recursion """
+        stack = [(self, depth, False)]
+        while stack:
+            node, depth, visited = stack.pop()
+            if node.inner is None:
+                continue
+            if visited:
+                for item in visitor.visit(node, depth):
                     yield item
-            for item in visitor.visit(self, depth):
-                yield item
+            else:
+                stack.append((node, depth, True))
+                for child in reversed(node.children):
+                    stack.append((child, depth+1, False))
 
-def astify(tokens, depth=0):
-    tokens = iter(tokens)
-    root = Node(inner="__ROOT__")
-    while True:
+def constant(node):
+    """ the value of a terminal that is a 16 bit literal, else None """
+    token = node.terminal
+    if token is None:
+        return None
+    if token.startswith("0x"):
         try:
-            token = tokens.next()
-            print token
-            if token == "(":
-                root.children.append(astify(tokens, depth+1))
-                if depth == 0:
-                    return root.children[0]
-            elif token == ")":
-                return root
-            else:
-                if root.inner == "__ROOT__":
-                    root.inner = token
-                else:
-                    root.children.append(Node(terminal=token))
-        except StopIteration:
-            raise Exception("No closing brace")
+            value = int(token, 16)
+        except ValueError:
+            return None
+    elif token.isdigit():
+        value = int(token)
+    else:
+        return None
+    return value if value <= 0xffff else None
+
+class NodeTable(object):
+    """ hash-consing: one Node for each distinct subtree, so a repeated
+        subexpression is a single node with several parents and the tree
+        becomes a DAG.  Nodes are interned once their children are, and
+        must not change afterwards. """
+    def __init__(self):
+        self.nodes = {}
+
+    def intern(self, node):
+        key = (node.inner, node.terminal, tuple(id(child) for child in node.children))
+        return self.nodes.setdefault(key, node)
+
+def distinct_nodes(ast):
+    """ each distinct node under ast once, children before parents """
+    order = []
+    seen = set()
+    stack = [(ast, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+        elif id(node) not in seen:
+            seen.add(id(node))
+            stack.append((node, True))
+            for child in reversed(node.children):
+                stack.append((child, False))
+    return order
+
+class FoldVisitor(object):
+    """ folds each inner node once its children have been folded """
+    def __init__(self, table):
+        self.table = table
+        self.folded = {}
+
+    def visit(self, node, depth):
+        if id(node) in self.folded:
+            return ()
+        children = [self.folded.get(id(child), child) for child in node.children]
+        values = [constant(child) for child in children]
+        if node.inner in FOLDS and len(values) == 2 and None not in values:
+            folded = Node(terminal=str(FOLDS[node.inner](*values)))
+        else:
+            folded = Node(inner=node.inner)
+            folded.children = children
+        self.folded[id(node)] = self.table.intern(folded)
+        return ()
+
+def fold_constants(node, table=None):
+    """ the tree with every operator whose operands are all literals
+        replaced by a terminal holding its value """
+    visitor = FoldVisitor(NodeTable() if table is None else table)
+    for item in node.accept_postorder(visitor):
+        pass
+    return visitor.folded.get(id(node), node)
+
+def astify(tokens, tracer=None, table=None):
+    """ the tree for the first parenthesised expression in tokens, built
+        with a stack of the nodes still open rather than by recursion.
+        Nodes are interned in table, so identical subtrees are shared. """
+    tokens = iter(tokens) if tracer is None else tracer.wrap("astify", tokens)
+    if table is None:
+        table = NodeTable()
+    stack = [Node(inner="__ROOT__")]
+    for token in tokens:
+        if token == "(":
+            stack.append(Node(inner="__ROOT__"))
+        elif token == ")":
+            node = table.intern(stack.pop())
+            if not stack:
+                return node
+            stack[-1].children.append(node)
+            if len(stack) == 1:
+                return node
+        elif stack[-1].inner == "__ROOT__":
+            stack[-1].inner = token
+        else:
+            stack[-1].children.append(table.intern(Node(terminal=token)))
+    raise Exception("No closing brace")
 
 class TranslateVisitor(object):
     def __init__(self, definitions_only):
         self.definitions_only = definitions_only
-        self.defined = []
+        self.defined = set()
         self.index = 0
 
     def define(self, op, nargs):
@@ -194,7 +394,6 @@ class TranslateVisitor(object):
         yield return_label+" SET PC, "+REG[-1]
 
     def translate_statement(self, op, args, start_label, swap_indices):
-        print op, args, start_label, swap_indices
         nargs = len(args)
         if nargs > len(REG)-1 or nargs == 0:
             raise Exception("Bad number of arguments: "+nargs)
@@ -228,7 +427,7 @@ class TranslateVisitor(object):
 
             if self.definitions_only:
                 for item in self.define(op, len(args)):
-                    self.defined.append(op)
+                    self.defined.add(op)
                     yield item
             else:
                 start_label = ":start"+str(self.index)
@@ -245,13 +444,238 @@ def translate_ast(ast):
     for item in ast.accept_postorder(TranslateVisitor(False)):
         yield item
 
-def translate(source):
+# Binary operators with a DCPU instruction of their own, which inline code
+# generation emits in place; anything else is still called out of line
+INLINE_OPS = set(FOLDS)
+
+class InlineGenerator(object):
+    """ generates code that evaluates the tree in registers, in
+        Sethi-Ullman order: the operand needing more registers goes first,
+        and a value is only pushed when the registers run out.  Operators
+        that have no instruction are called through their :start_OP
+        routines as before, saving any live registers the routine uses.
+
+        With cse, every subexpression the DAG reaches more than once is
+        evaluated once, before the rest, and every use then reads its
+        value.  Up to half the free registers hold the values that save
+        the most work; the rest are kept in scratch words at fixed
+        addresses, which the program jumps over at its start. """
+    def __init__(self, ast, cse=False):
+        nodes = distinct_nodes(ast)
+        # registers the expression names itself are left alone
+        terminals = set(node.terminal for node in nodes)
+        self.pool = [r for r in REG if r not in terminals]
+        self.needs = {}
+        self.outlined = []
+        # shared node -> its register or scratch word, and the operand for
+        # each shared node evaluated so far
+        self.pinned = {}
+        self.slots = {}
+        self.ready = {}
+        self.shared = []
+        if cse:
+            self.share(nodes)
+        for node in nodes:
+            if node.inner is not None:
+                self.visit(node, 0)
+
+    def share(self, nodes):
+        """ pick a register or scratch word for each shared node """
+        uses = {}
+        sizes = {}
+        clobbered = set()
+        for node in nodes:
+            sizes[id(node)] = 1 + sum(sizes[id(child)] for child in node.children)
+            for child in node.children:
+                uses[id(child)] = uses.get(id(child), 0) + 1
+            if node.inner is not None and not self.inline(node):
+                clobbered.update(REG[:len(node.children)] + REG[-1])
+        # registers no routine overwrites, taken from the end of the pool
+        # at least two registers stay free for evaluating everything else
+        free = [r for r in reversed(self.pool) if r not in clobbered]
+        free = free[:max(0, min(len(self.pool) / 2, len(self.pool) - 2))]
+        candidates = [node for node in nodes if node.inner is not None and uses.get(id(node), 0) > 1]
+        candidates.sort(key=lambda node: -sizes[id(node)] * (uses[id(node)] - 1))
+        for node, r in zip(candidates, free):
+            self.pinned[id(node)] = r
+        # children before parents, so each can use the ones inside it
+        shared = set(id(node) for node in candidates)
+        self.shared = [node for node in nodes if id(node) in shared]
+        overflow = [node for node in self.shared if id(node) not in self.pinned]
+        # ADD PC, n is one word while n is a short literal
+        base = 1 if len(overflow) <= SHORT_LITERAL_MAX else 2
+        for i, node in enumerate(overflow):
+            self.slots[id(node)] = "[0x%x]" % (base + i)
+        self.pool = [r for r in self.pool if r not in self.pinned.values()]
+
+    def usable(self):
+        """ whether enough registers are free to evaluate in them """
+        return len(self.pool) >= 2
+
+    def inline(self, node):
+        return node.inner in INLINE_OPS and len(node.children) == 2
+
+    def leaf(self, node):
+        """ whether node is used as an operand as it stands """
+        return node.terminal is not None or id(node) in self.pinned or id(node) in self.slots
+
+    def operand(self, node):
+        """ the operand text for a terminal or an evaluated shared node """
+        if node.terminal is not None:
+            return node.terminal
+        return self.ready.get(id(node))
+
+    def need(self, node):
+        """ the registers node needs to be evaluated without pushing """
+        if self.leaf(node):
+            return 1
+        return self.needs[id(node)]
+
+    def visit(self, node, depth):
+        """ works out a node's need once its children's are known """
+        if self.inline(node):
+            left, right = node.children
+            l = self.need(left)
+            r = 0 if self.leaf(right) else self.need(right)
+            need = l + 1 if l == r else max(l, r)
+        else:
+            # a call overwrites the routine's registers, so it goes
+            # first as if it needed them all
+            clobbered = set(REG[:len(node.children)] + REG[-1]) & set(self.pool)
+            need = max([len(clobbered) + 1] + [self.need(child) for child in node.children])
+        self.needs[id(node)] = need
+        return ()
+
+    def definitions(self, ast):
+        """ routines for the operators called out of line, in the order
+            they are first used """
+        defined = set()
+        visitor = TranslateVisitor(True)
+        stack = [ast]
+        while stack:
+            node = stack.pop()
+            if node.inner is not None:
+                if not self.inline(node) and node.inner not in defined:
+                    defined.add(node.inner)
+                    self.outlined.append((node.inner, len(node.children)))
+                stack.extend(node.children)
+        for op, nargs in self.outlined:
+            for item in visitor.define(op, nargs):
+                yield item
+
+    def generate(self, node, regs):
+        """ lines leaving the value of node in regs[0], using only regs """
+        # lines to emit, and (node, regs) still to be expanded into lines
+        work = [(node, regs)]
+        while work:
+            item = work.pop()
+            if isinstance(item, basestring):
+                yield item
+            else:
+                work.extend(reversed(self.steps(*item)))
+
+    def steps(self, node, regs):
+        """ evaluating node into regs[0], as lines and (node, regs) to
+            evaluate in turn """
+        r = regs[0]
+        if self.operand(node) is not None:
+            return ["SET "+r+", "+self.operand(node)]
+        if not self.inline(node):
+            return self.call(node, regs)
+        op = node.inner
+        left, right = node.children
+        if self.operand(right) is not None:
+            return [(left, regs), op+" "+r+", "+self.operand(right)]
+        l, n = self.need(left), self.need(right)
+        if l >= n and n < len(regs):
+            return [(left, regs), (right, regs[1:]), op+" "+r+", "+regs[1]]
+        if l < n and l < len(regs):
+            return [(right, [regs[1], r] + regs[2:]), (left, [r] + regs[2:]), op+" "+r+", "+regs[1]]
+        # both sides need every register: park the right one
+        return [(right, regs), "SET PUSH, "+r, (left, regs), "SET "+regs[1]+", POP", op+" "+r+", "+regs[1]]
+
+    def call(self, node, regs):
+        """ an out of line call, as translate_statement makes it """
+        nargs = len(node.children)
+        clobbered = set(REG[:nargs] + REG[-1])
+        saved = [x for x in self.pool if x not in regs and x in clobbered]
+        steps = ["SET PUSH, "+x for x in saved]
+        for child in reversed(node.children):
+            if self.operand(child) is not None:
+                steps.append("SET PUSH, "+self.operand(child))
+            else:
+                steps.append((child, regs))
+                steps.append("SET PUSH, "+regs[0])
+        steps.append("JSR :start_"+node.inner)
+        steps.append("SET "+regs[0]+", POP")
+        steps.extend("SET "+x+", POP" for x in reversed(saved))
+        return steps
+
+    def translate(self, ast):
+        definitions = list(self.definitions(ast))
+        if self.slots:
+            # the scratch words, at fixed addresses just past this jump
+            yield "ADD PC, %d" % len(self.slots)
+            yield "DAT " + ", ".join(["0"] * len(self.slots))
+        if definitions:
+            # jump over the routines
+            yield "SET PC, :start0"
+        for item in definitions:
+            yield item
+        prefix = ":start0 "
+        for node in self.shared:
+            if id(node) in self.pinned:
+                r = self.pinned[id(node)]
+                lines = self.generate(node, [r] + self.pool)
+            else:
+                r = self.slots[id(node)]
+                lines = chain(self.generate(node, self.pool), ["SET "+r+", "+self.pool[0]])
+            for item in lines:
+                yield prefix+item
+                prefix = ""
+            self.ready[id(node)] = r
+        for item in self.generate(ast, self.pool):
+            yield prefix+item
+            prefix = ""
+        if self.pool[0] != REG[0]:
+            yield "SET "+REG[0]+", "+self.pool[0]
+        yield ":return0 SET PC, :return0"
+
+def translate(source, tracer=None, fold=False, inline=False, cse=False):
+    """ translate an expression to assembly lines; with fold, operators on
+        literals are evaluated here rather than by the generated code, with
+        inline, operators are evaluated in registers rather than by calling
+        a routine for each, and with cse (which implies inline), repeated
+        subexpressions are evaluated once """
+    lines = translate_lines(source, tracer, fold, inline or cse, cse)
+    return lines if tracer is None else tracer.wrap("translate", lines)
+
+def translate_lines(source, tracer, fold=False, inline=False, cse=False):
     tokens = tokenize(source)
     prologue = ["SET PC, :start0"]
     epilogue = ["SET "+REG[0]+", POP", ":return0 SET PC, :return0"]
     
-    ast = astify(tokens)
-    print ast
+    # the unit is one expression; folding interns into the same table, so
+    # a subtree it folds to one already there is shared too
+    table = NodeTable()
+    ast = astify(tokens, tracer=tracer, table=table)
+    if fold:
+        ast = fold_constants(ast, table)
+    if tracer is not None:
+        tracer.event("translate", ast)
+
+    if ast.terminal is not None:
+        # the whole expression folded to one value
+        yield ":start0 SET "+REG[0]+", "+ast.terminal
+        yield epilogue[-1]
+        return
+    if inline:
+        generator = InlineGenerator(ast, cse)
+        # otherwise the routines are called for every operator, as below
+        if generator.usable():
+            for item in generator.translate(ast):
+                yield item
+            return
 
     for item in prologue:
         yield item
@@ -273,11 +697,177 @@ def test_translate():
         assert gendasm == dasm
         print "\n".join(gendasm)
 
+def test_fold():
+    """ folded programs must leave the value the unfolded ones compute """
+    import random
+    from assembler import assemble
+    from emu import DCPU
+    for source, dasm in fold_cases:
+        assert list(translate(source, fold=True)) == dasm
+    rng = random.Random(22)
+    edges = [0, 1, 2, 15, 16, 17, 0x7fff, 0x8000, 0xfffe, 0xffff]
+    def expression(depth):
+        if depth == 0:
+            value = rng.choice(edges + [rng.randint(0, 0xffff)])
+            return rng.choice(["%d", "0x%x"]) % value
+        return "(%s %s %s)" % (rng.choice(sorted(FOLDS)), expression(depth - 1),
+                               expression(rng.randint(0, depth - 1)))
+    for i in xrange(300):
+        source = expression(rng.randint(1, 4))
+        results = []
+        for fold in [False, True]:
+            dcpu = DCPU()
+            dcpu.load_program(list(assemble(list(translate(source, fold=fold)))))
+            assert dcpu.run(100000)[0] == "halt"
+            results.append((dcpu.registers["X"], dcpu.cycles))
+        (plain, plain_cycles), (folded, folded_cycles) = results
+        assert plain == folded, (source, plain, folded)
+        assert folded_cycles < plain_cycles
+    print "--------"
+    print source, "=", folded, "in", folded_cycles, "cycles, not", plain_cycles
+
+def test_inline():
+    """ inline code must compute what the routine calls do, in fewer
+        cycles, spilling to the stack on trees deeper than the registers """
+    import random
+    from assembler import assemble
+    from emu import DCPU
+    for source, dasm in inline_cases:
+        assert list(translate(source, inline=True)) == dasm
+    # naming all but one register leaves too few to evaluate in
+    source = "(ADD (ADD (ADD A B) (ADD C I)) (ADD (ADD J X) Y))"
+    assert list(translate(source, inline=True)) == list(translate(source, cse=True)) == \
+           list(translate(source))
+    rng = random.Random(23)
+    def expression(depth, full):
+        if depth == 0:
+            return str(rng.randint(0, 0xffff))
+        ops = sorted(INLINE_OPS) + ["SET"]
+        return "(%s %s %s)" % (rng.choice(ops), expression(depth - 1, full),
+                               expression(depth - 1 if full else rng.randint(0, depth - 1), full))
+    sources = [expression(rng.randint(1, 6), False) for i in xrange(200)]
+    sources += [expression(depth, True) for depth in (8, 9)]
+    for source in sources:
+        results = []
+        for inline in [False, True]:
+            lines = list(translate(source, inline=inline))
+            dcpu = DCPU()
+            dcpu.load_program(list(assemble(lines)))
+            assert dcpu.run(1000000)[0] == "halt"
+            results.append((dcpu.registers["X"], dcpu.cycles, dcpu.registers["SP"], len(lines)))
+        plain, inlined = results
+        assert plain[0] == inlined[0], (source, plain, inlined)
+        assert inlined[2] == 0xffff
+        # a lone call compiles the same either way
+        assert inlined[1] < plain[1] or source.startswith("(SET"), (source, plain, inlined)
+        assert ("SET" in source) == any(line.startswith(":start_SET") for line in lines)
+        assert not any(line.startswith(":start_ADD") for line in lines)
+    print "--------"
+    print "INLINE depth 9:", inlined[3], "lines,", inlined[1], "cycles, not", plain[3], "lines,", plain[1], "cycles"
+
+def test_deep():
+    """ tokens don't depend on how the input is split, and expressions
+        nested far past the recursion limit still translate """
+    import sys
+    from assembler import assemble
+    from emu import DCPU
+    source = "(MUL\t(ADD 1 0x2) ; one (two)\n(SUB 5 3)) ; done"
+    tokens = list(tokenize(source))
+    assert tokens == ["(", "MUL", "(", "ADD", "1", "0x2", ")", "(", "SUB", "5", "3", ")", ")"]
+    for size in [1, 2, 3, 7, len(source)]:
+        chunks = [source[i:i+size] for i in xrange(0, len(source), size)]
+        assert list(tokenize(chunks)) == tokens
+    assert list(tokenize(source.splitlines(True))) == tokens
+    depth = sys.getrecursionlimit() * 3
+    source = "(ADD 1 " * depth + "(SUB 2 1" + ")" * (depth + 1)
+    ast = astify(tokenize(source))
+    assert str(ast).count("<Node>") == depth * 2 + 3
+    results = []
+    for options in [{}, {"inline": True}, {"fold": True}]:
+        lines = list(translate(source, **options))
+        dcpu = DCPU()
+        dcpu.load_program(list(assemble(lines)))
+        assert dcpu.run(10000000)[0] == "halt"
+        results.append((dcpu.registers["X"], len(lines)))
+    assert [x for x, n in results] == [depth + 1] * 3
+    print "--------"
+    print "DEEP depth", depth, "lines", [n for x, n in results]
+
+def test_cse():
+    """ identical subtrees are one node, and sharing their values must
+        compute what evaluating every copy does """
+    import random
+    from assembler import assemble
+    from emu import DCPU
+    for source, dasm in cse_cases:
+        assert list(translate(source, cse=True)) == dasm
+    ast = astify(tokenize("(ADD (MUL 3 4) (SUB (MUL 3 4) (MUL 3 4)))"))
+    assert ast.children[0] is ast.children[1].children[0] is ast.children[1].children[1]
+    assert len(distinct_nodes(ast)) == 5
+    table = NodeTable()
+    ast = fold_constants(astify(tokenize("(SUB (ADD (ADD 1 2) A) (ADD 3 A))"), table=table), table)
+    assert ast.children[0] is ast.children[1]
+    rng = random.Random(25)
+    def expression(depth, common):
+        if depth == 0 or rng.random() < 0.2:
+            return rng.choice(common) if rng.random() < 0.5 else str(rng.randint(0, 0xffff))
+        ops = sorted(INLINE_OPS) + ["SET"]
+        return "(%s %s %s)" % (rng.choice(ops), expression(depth - 1, common),
+                               expression(depth - 1, common))
+    totals = [0, 0]
+    # registers the routines never touch, as operands that shrink the pool
+    named = ["A", "B", "C", "I", "J"]
+    values = dict((r, rng.randint(0, 0xffff)) for r in named)
+    for i in xrange(300):
+        leaves = ["1", "2"] if i < 150 else rng.sample(named, rng.randint(1, len(named)))
+        common = [expression(2, leaves) for j in xrange(rng.randint(1, 6))]
+        source = "(XOR %s %s)" % (expression(rng.randint(1, 5), common), expression(rng.randint(1, 5), common))
+        results = []
+        for options in [{}, {"inline": True}, {"cse": True}]:
+            lines = list(translate(source, **options))
+            dcpu = DCPU()
+            for r in named:
+                dcpu.registers[r] = values[r]
+            dcpu.load_program(list(assemble(lines)))
+            assert dcpu.run(1000000)[0] == "halt"
+            results.append((dcpu.registers["X"], dcpu.cycles, dcpu.registers["SP"]))
+        assert results[0][0] == results[1][0] == results[2][0], (source, results)
+        assert results[2][2] == 0xffff
+        # one instruction or call for each distinct operator node, leaving
+        # out labels and the jump over the scratch words
+        words = [line.split() for line in lines]
+        ops = [w[1] if w[0].startswith(":") else w[0] for w in words if w[1] != "PC,"]
+        assert sum(1 for op in ops if op in INLINE_OPS or op == "JSR") == \
+               sum(1 for node in distinct_nodes(astify(tokenize(source))) if node.inner), source
+        totals[0] += results[1][1]
+        totals[1] += results[2][1]
+    assert totals[1] < totals[0]
+    # more scratch words than ADD PC can skip with a short literal
+    terms = ["(MUL A %d)" % (i + 2) for i in xrange(40)]
+    source = reduce(lambda left, term: "(ADD %s %s)" % (left, term), terms * 2)
+    lines = list(translate(source, cse=True))
+    # three of them in registers
+    assert lines[0] == "ADD PC, 37" and sum(1 for line in lines if "MUL" in line) == 40
+    for options in [{}, {"cse": True}]:
+        dcpu = DCPU()
+        dcpu.registers["A"] = 3
+        dcpu.load_program(list(assemble(list(translate(source, **options)))))
+        assert dcpu.run(1000000)[0] == "halt"
+        assert dcpu.registers["X"] == 2 * 3 * sum(xrange(2, 42)) & 0xffff
+    print "--------"
+    print "CSE", totals[1], "cycles, not", totals[0], "inline"
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
         with open(sys.argv[1]) as f:
-            program = list(translate(f.readlines()))
+            # trans.py [source] [--fold] [--inline] [--cse]
+            program = list(translate(f.readlines(), fold="--fold" in sys.argv,
+                                     inline="--inline" in sys.argv, cse="--cse" in sys.argv))
             print program
             sys.exit()
     test_translate()
+    test_fold()
+    test_inline()
+    test_deep()
+    test_cse()